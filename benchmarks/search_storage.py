@@ -0,0 +1,59 @@
+"""
+Size of the search index with each content storage mode (search_content_storage), and the time of a search
+with highlights.
+
+    python benchmarks/search_storage.py [wiki_directory] [--term wiki]
+
+The index of the wiki directory (the example wiki by default) is built in a temporary directory for each mode.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from search import CONTENT_STORAGE, Search  # noqa: E402
+
+
+def wiki_files(wiki_directory: str) -> list:
+    files = []
+    for root, dirs, names in os.walk(wiki_directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        relpath = os.path.relpath(root, wiki_directory)
+        for name in names:
+            title, extension = os.path.splitext(name)
+            if extension.lower() == ".md":
+                files.append((name, title, relpath))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("wiki_directory", nargs="?", default=os.path.join(os.path.dirname(__file__), "..", "wiki"))
+    parser.add_argument("--term", default="wiki")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    files = wiki_files(args.wiki_directory)
+    print(f"{len(files)} pages in {args.wiki_directory}")
+    for storage in CONTENT_STORAGE:
+        index_path = tempfile.mkdtemp()
+        try:
+            search = Search(index_path, create=True, cache_size=0, content_storage=storage,
+                            wiki_directory=args.wiki_directory)
+            search.index_all(args.wiki_directory, files, procs=os.cpu_count() or 1)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                _, total, _, _ = search.search(args.term, 1, suggest_below=0)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            print(f"{storage:5} {search.size() / 1024 / 1024:8.2f} MiB  "
+                  f"search '{args.term}' ({total} results) {elapsed * 1000:6.1f} ms")
+            search.close()
+        finally:
+            shutil.rmtree(index_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+Benchmarks of the main paths of the wiki on a generated wiki: building the search index (setup_search), rendering
+pages (file_page, cold then cached), listing folders (list_wiki), searching, and the knowledge graph (built from
+scratch, and its view).
+
+    python benchmarks/suite.py [--pages 1000] [--size 2000] [--depth 3] [--links 5] [--images 1] [--seed 1]
+                               [--output results.json] [--compare baseline.json] [--threshold 0.2]
+    python benchmarks/suite.py --load results.json --compare baseline.json
+
+The wiki is generated in a temporary directory, the same parameters and seed always give the same wiki.
+The results (milliseconds per call) are written as JSON with --output. With --compare, the medians are compared
+with a previous run and the exit status is 1 if one of them is slower by more than the threshold.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+RESULTS_VERSION = 1
+
+WORDS = ("wiki page search index markdown table server backup deploy network storage config user admin "
+         "release build test docker python linux cache render plugin image folder runbook oncall vpn "
+         "database migration monitoring alert dashboard ticket incident review").split()
+
+# 1x1 transparent png
+PNG = bytes.fromhex("89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+                    "0000000d4944415478da63f8ffff3f0005fe02fea7d6a4b20000000049454e44ae426082")
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def generate_wiki(directory: str, pages: int, size: int, depth: int, links: int, images: int, seed: int) -> List[str]:
+    """
+    Function that writes a wiki of `pages` pages of about `size` bytes in folders nested up to `depth` levels,
+    each page with `links` links to other pages and `images` images, and returns the paths of the pages
+    (without the extension).
+    """
+    rng = random.Random(seed)
+    # about 50 pages per folder, "" is the root of the wiki
+    folders = [""]
+    for n in range(pages // 50 if depth > 0 else 0):
+        parent = rng.choice([f for f in folders if (f.count("/") + 1 if f else 0) < depth])
+        folders.append(f"{parent}/folder{n}".strip("/"))
+    paths = [f"{rng.choice(folders)}/page {n} {rng.choice(WORDS)}".strip("/") for n in range(pages)]
+
+    os.makedirs(os.path.join(directory, "img"), exist_ok=True)
+    for n in range(images * 10):
+        with open(os.path.join(directory, "img", f"image{n}.png"), "wb") as f:
+            f.write(PNG)
+
+    for path in paths:
+        lines = ["---", f"tags: [{rng.choice(WORDS)}, {rng.choice(WORDS)}]", "---", "", f"# {os.path.basename(path)}"]
+        for target in rng.sample(paths, min(links, len(paths))):
+            lines.append(f"See [{os.path.basename(target)}](/{target.replace(' ', '%20')}).")
+        for _ in range(images):
+            lines.append(f"![image](/img/image{rng.randrange(images * 10)}.png)")
+        while sum(len(line) + 1 for line in lines) < size:
+            kind = rng.random()
+            if kind < 0.1:
+                lines += ["", f"## {sentence(rng, 3)}", ""]
+            elif kind < 0.15:
+                lines += ["", "| name | value |", "|------|-------|"]
+                lines += [f"| {rng.choice(WORDS)} | {rng.randrange(1000)} |" for _ in range(5)]
+                lines.append("")
+            elif kind < 0.2:
+                lines += ["", "```", f"{rng.choice(WORDS)} --{rng.choice(WORDS)} {rng.randrange(100)}", "```", ""]
+            else:
+                lines.append(sentence(rng, rng.randrange(8, 20)))
+        full_path = os.path.join(directory, f"{path}.md")
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    with open(os.path.join(directory, "homepage.md"), "w") as f:
+        f.write("# Homepage\n\n" + "\n".join(f"- [{os.path.basename(p)}](/{p.replace(' ', '%20')})"
+                                             for p in paths[:20]) + "\n")
+    return paths
+
+
+def summary(times: List[float]) -> Dict[str, float]:
+    return {
+        "runs": len(times),
+        "min_ms": min(times) * 1000,
+        "median_ms": statistics.median(times) * 1000,
+        "mean_ms": statistics.mean(times) * 1000,
+        "max_ms": max(times) * 1000,
+    }
+
+
+def measure(call: Callable[[], object], repeat: int = 1) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def get(client, url: str):
+    response = client.get(url)
+    assert response.status_code == 200, f"{url}: {response.status_code}"
+    return response
+
+
+def run_suite(args) -> dict:
+    """
+    Function that generates the wiki, points the configuration of the wiki to it and runs the benchmarks.
+    """
+    work = args.directory or tempfile.mkdtemp(prefix="wikmd-bench-")
+    wiki_directory = os.path.join(work, "wiki")
+    shutil.rmtree(wiki_directory, ignore_errors=True)
+    start = time.perf_counter()
+    paths = generate_wiki(wiki_directory, args.pages, args.size, args.depth, args.links, args.images, args.seed)
+    print(f"Generated {len(paths)} pages in {time.perf_counter() - start:.1f}s >>> {wiki_directory}")
+
+    # the configuration is read when the wiki module is imported
+    os.environ["WIKI_DIRECTORY"] = wiki_directory
+    os.environ["CACHE_DIR"] = os.path.join(work, "cache")
+    os.environ["SEARCH_DIR"] = os.path.join(work, "searchindex")
+    os.environ["CACHE_INVALIDATION"] = args.invalidation
+    for folder in ("cache", "searchindex"):
+        shutil.rmtree(os.path.join(work, folder), ignore_errors=True)
+    os.chdir(ROOT)
+    import knowledge_graph
+    import wiki
+    wiki.app.logger.setLevel(logging.WARNING)
+    # the state of a running wiki: file system events keep the catalog and the cache current
+    wiki.catalog.verify = wiki.cache.verify = args.invalidation == "verify"
+    client = wiki.app.test_client()
+
+    rng = random.Random(args.seed)
+    sample = rng.sample(paths, min(args.sample, len(paths)))
+    folders = sorted({os.path.dirname(path) for path in paths} - {""})
+    results = {}
+
+    def record(name: str, times: List[float]):
+        results[name] = summary(times)
+        print(f"{name:24} {results[name]['median_ms']:10.2f} ms (median of {len(times)})")
+
+    record("catalog_scan", measure(wiki.catalog.scan))
+    record("setup_search", measure(wiki.setup_search))
+    record("setup_search_unchanged", measure(wiki.setup_search, args.repeat))
+    record("file_page_cold", [measure(lambda: get(client, f"/{path}"))[0] for path in sample])
+    record("file_page_warm", [measure(lambda: get(client, f"/{path}"))[0] for path in sample])
+    record("list_wiki", measure(lambda: get(client, "/list/"), args.repeat))
+    if folders:
+        record("list_wiki_folder", [measure(lambda: get(client, f"/list/{folder}/"))[0]
+                                    for folder in rng.sample(folders, min(args.repeat, len(folders)))])
+    terms = [f"{rng.choice(WORDS)} {rng.choice(WORDS)}" for _ in range(args.repeat)]
+    record("search", [measure(lambda: get(client, f"/?q={term}"))[0] for term in terms])
+    record("search_cached", [measure(lambda: get(client, f"/?q={term}"))[0] for term in terms])
+    record("knowledge_graph_build", measure(lambda: knowledge_graph.find_links(wiki.catalog), args.repeat))
+    record("knowledge_graph", measure(lambda: get(client, "/knowledge-graph"), args.repeat))
+
+    if wiki.search_index is not None:
+        wiki.search_index.close()
+    if not args.directory:
+        shutil.rmtree(work, ignore_errors=True)
+    return {
+        "version": RESULTS_VERSION,
+        "parameters": {name: getattr(args, name) for name in
+                       ("pages", "size", "depth", "links", "images", "seed", "sample", "repeat", "invalidation")},
+        "environment": environment(),
+        "results": results,
+    }
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    """
+    Function that prints the medians of two runs side by side and returns the names of the benchmarks that are
+    slower than the baseline by more than `threshold` (0.2 = 20%).
+    """
+    if baseline.get("parameters") != current.get("parameters"):
+        print(f"Warning: different parameters >>> {baseline.get('parameters')} vs {current.get('parameters')}")
+    regressions = []
+    print(f"{'benchmark':24} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before, after = baseline["results"][name]["median_ms"], result["median_ms"]
+        change = (after - before) / before if before else 0
+        slower = change > threshold
+        if slower:
+            regressions.append(name)
+        print(f"{name:24} {before:10.2f} {after:10.2f} {change * 100:+7.1f}%{'  slower' if slower else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=2000, help="bytes per page")
+    parser.add_argument("--depth", type=int, default=3, help="levels of folders")
+    parser.add_argument("--links", type=int, default=5, help="links per page")
+    parser.add_argument("--images", type=int, default=1, help="images per page")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--sample", type=int, default=20, help="pages rendered")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--invalidation", choices=("events", "verify"), default="events")
+    parser.add_argument("--directory", help="keep the generated wiki, cache and index in this directory")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--load", help="compare the results of this JSON file instead of running the benchmarks")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.load:
+        with open(args.load) as f:
+            current = json.load(f)
+    else:
+        current = run_suite(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"Slower than the baseline >>> {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
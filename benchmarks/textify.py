@@ -0,0 +1,102 @@
+"""
+Benchmark of the text extraction for the search index: the previous implementation (Markdown rendering +
+BeautifulSoup) against plaintext.markdown_to_text.
+
+    python benchmarks/textify.py [--pages 500] [--repeat 3]
+
+The corpus is made of the pages of the example wiki and of the docs, plus generated pages with the usual content
+of a wiki (long tables, code blocks, nested lists, links and images).
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+
+from bs4 import BeautifulSoup
+from markdown import Markdown
+from whoosh.analysis import StandardAnalyzer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from plaintext import markdown_to_text  # noqa: E402
+
+WORDS = ("wiki page search index markdown table server backup deploy network storage config user admin "
+         "release build test docker python linux cache render plugin image folder").split()
+
+
+def markdown_bs4_text(text: str) -> str:
+    md = Markdown(extensions=["meta", "extra"])
+    return BeautifulSoup(md.convert(text), "html.parser").get_text()
+
+
+def sentence(rng: random.Random, n: int = 12) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+
+def synthetic_page(rng: random.Random) -> str:
+    parts = [f"# {sentence(rng, 4)}", ""]
+    for section in range(rng.randint(2, 6)):
+        parts += [f"## Section {section} {rng.choice(WORDS)}", "", sentence(rng, 30) + " **" + rng.choice(WORDS) +
+                  "** and [a link](/" + rng.choice(WORDS) + ") and `" + rng.choice(WORDS) + "_code`", ""]
+        kind = rng.choice(("table", "code", "list", "quote"))
+        if kind == "table":
+            parts += ["| name | value | notes |", "|------|:-----:|-------|"]
+            parts += [f"| {rng.choice(WORDS)} | {rng.randint(0, 999)} | {sentence(rng, 6)} |"
+                      for _ in range(rng.randint(20, 200))]
+        elif kind == "code":
+            parts += ["```python"] + [f"{rng.choice(WORDS)} = {rng.randint(0, 99)}  # {rng.choice(WORDS)}"
+                                       for _ in range(rng.randint(5, 40))] + ["```"]
+        elif kind == "list":
+            for _ in range(rng.randint(3, 15)):
+                parts += [f"- {sentence(rng, 8)}", f"    - *{rng.choice(WORDS)}* {sentence(rng, 5)}"]
+        else:
+            parts += [f"> {sentence(rng, 20)}", f"> ![{rng.choice(WORDS)}](/img/{rng.choice(WORDS)}.png)"]
+        parts.append("")
+    return "\n".join(parts)
+
+
+def corpus(pages: int) -> list:
+    root = os.path.join(os.path.dirname(__file__), "..")
+    documents = []
+    for path in glob.glob(os.path.join(root, "wiki", "*.md")) + glob.glob(os.path.join(root, "docs", "*.md")):
+        with open(path, encoding="utf-8") as f:
+            documents.append(f.read())
+    rng = random.Random(0)
+    documents += [synthetic_page(rng) for _ in range(max(0, pages - len(documents)))]
+    return documents
+
+
+def timed(function, documents: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for document in documents:
+            function(document)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    documents = corpus(args.pages)
+    size = sum(len(d) for d in documents)
+    print(f"{len(documents)} pages, {size / 1024 / 1024:.1f} MiB of markdown")
+
+    analyzer = StandardAnalyzer()
+    same = sum({t.text for t in analyzer(markdown_bs4_text(d))} == {t.text for t in analyzer(markdown_to_text(d))}
+               for d in documents)
+    print(f"same search terms: {same}/{len(documents)} pages")
+
+    reference = timed(markdown_bs4_text, documents, args.repeat)
+    fast = timed(markdown_to_text, documents, args.repeat)
+    print(f"markdown + bs4   {reference:8.3f} s  {len(documents) / reference:8.0f} pages/s")
+    print(f"markdown_to_text {fast:8.3f} s  {len(documents) / fast:8.0f} pages/s  ({reference / fast:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
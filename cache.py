@@ -1,26 +1,539 @@
+import gzip
+import json
 import os
-from shutil import rmtree
-from typing import Optional
+import re
+import tempfile
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Event, Lock
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
-import cachelib
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+# Bump when the layout of the cached entries changes, so old entries are never served.
+CACHE_FORMAT_VERSION = "1"
 
-class Cache:
-    cache: cachelib.FileSystemCache
+EVICTION_POLICIES = ("lru", "lfu")
+# 'events': files are only checked again when a change is reported, 'verify': files are checked on each lookup
+INVALIDATION_MODES = ("events", "verify")
+# When the disk tier is full it is pruned down to this fraction of its limits, so pruning doesn't run on every set.
+PRUNE_TARGET = 0.9
+_ENTRY_NAME = re.compile(r"^[0-9a-f]{64}$")
+
+# content encodings of the precompressed responses, by order of preference
+RESPONSE_ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """
+    Function that compresses data with one of the RESPONSE_ENCODINGS.
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(data, GZIP_LEVEL)
+    raise ValueError(f"Unsupported content encoding '{encoding}'")
+
+
+def render_fingerprint(*parts: Iterable) -> str:
+    """
+    Function that returns a stable hash of the render pipeline configuration
+    (pandoc version, extra args, filters, enabled plugins, ...).
+    A change in any of those parts results in different cache keys.
+    """
+    hasher = sha256(CACHE_FORMAT_VERSION.encode("utf-8"))
+    for part in parts:
+        hasher.update(b"\0")
+        hasher.update(repr(part).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def file_stamps(paths: Iterable[str]) -> Dict[str, Optional[List[int]]]:
+    """
+    Function that returns the (mtime_ns, size) of each file, None for the files that don't exist.
+    """
+    stamps = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamps[path] = [st.st_mtime_ns, st.st_size]
+        except OSError:
+            stamps[path] = None
+    return stamps
+
+
+class MemoryCache:
+    """
+    Class that implements a bounded in-memory LRU cache.
+    The size is bounded in bytes of cached content, not in number of entries.
+    Entries can be text or bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[Union[str, bytes], int]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[Union[str, bytes]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, content: Union[str, bytes]):
+        size = len(content) if isinstance(content, bytes) else len(content.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (content, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
 
-    def __init__(self, path: str):
-        if os.path.exists(path):
-            rmtree(path)  # delete an existing cache on start/restart
-        os.makedirs(path)
-        self.cache = cachelib.FileSystemCache(path)
+
+class DiskCache:
+    """
+    Class that implements a bounded file system cache.
+    Each entry is stored as a plain file named by its key (text is utf-8 encoded). The cache is bounded both in
+    number of entries and in bytes, and entries are evicted with an explicit policy: least recently used ('lru') or least
+    frequently used ('lfu').
+    """
+
+    def __init__(self, path: str, max_entries: int, max_bytes: int, policy: str = "lru"):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown cache eviction policy '{policy}', expected one of {EVICTION_POLICIES}")
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> [size, last_access, access_count], ordered from least to most recently used
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """
+        Rebuilds the index from the entries already on disk, oldest first.
+        Files that are not cache entries (leftovers of interrupted writes or older cache formats) are removed.
+        """
+        found = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                if not _ENTRY_NAME.match(entry.name):
+                    os.remove(entry.path)
+                    continue
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        for mtime, key, size in sorted(found):
+            self._entries[key] = [size, mtime, 0]
+            self.size += size
+        with self._lock:
+            self._prune()
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
 
     def get(self, key: str) -> Optional[str]:
-        if self.cache.has(key):
-            if os.path.getmtime(key) > os.path.getmtime(self.cache._get_filename(key)):
-                self.cache.delete(key)
+        content = self.get_bytes(key)
+        return None if content is None else content.decode("utf-8")
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
                 return None
-            return self.cache.get(key)
-        return None
+            self._entries.move_to_end(key)
+            entry[1] = time.time()
+            entry[2] += 1
+        try:
+            with open(self._filename(key), "rb") as f:
+                content = f.read()
+        except OSError:
+            self.delete(key)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def set(self, key: str, content: Union[str, bytes]):
+        data = content if isinstance(content, bytes) else content.encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._filename(key))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[0]
+            self._entries[key] = [len(data), time.time(), 0 if old is None else old[2]]
+            self.size += len(data)
+            if len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._prune(keep=key)
+
+    def delete(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[0]
+        try:
+            os.remove(self._filename(key))
+        except FileNotFoundError:
+            pass
+
+    def _prune(self, keep: Optional[str] = None):
+        """
+        Evicts entries according to the policy until the cache is below PRUNE_TARGET of its limits.
+        The entry `keep` (the one just stored) is never evicted. Must be called with the lock held.
+        """
+        if len(self._entries) <= self.max_entries and self.size <= self.max_bytes:
+            return
+        max_entries = int(self.max_entries * PRUNE_TARGET)
+        max_bytes = int(self.max_bytes * PRUNE_TARGET)
+        if self.policy == "lfu":
+            # OrderedDict order breaks ties between equally used entries in favour of the recent ones
+            victims = sorted(self._entries, key=lambda k: self._entries[k][2])
+        else:
+            victims = list(self._entries)
+        for key in victims:
+            if len(self._entries) <= max_entries and self.size <= max_bytes:
+                break
+            if key == keep:
+                continue
+            size = self._entries.pop(key)[0]
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._filename(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class _Flight:
+    def __init__(self):
+        self.done = Event()
+        self.result: Optional[str] = None
+        self.error: Optional[Exception] = None
+
+
+class SingleFlight:
+    """
+    Class that deduplicates concurrent calls for the same key:
+    the first caller runs the function, the callers arriving while it runs wait for it and share its result
+    (or its exception).
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = Lock()
+
+    def do(self, key: str, fn: Callable[[], str]) -> str:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+
+class Cache:
+    """
+    Class that caches the rendered html of the wiki pages.
+    Entries are content addressed: the key is a hash of the markdown source plus the render fingerprint,
+    so the cache survives restarts and an entry is only invalidated when the page or the pipeline changes.
+    Hot entries are kept in an in-memory LRU tier in front of the bounded file system tier.
+
+    With `verify` set, the markdown files and the files the pages depend on are checked (stat) on each lookup.
+    Otherwise what is known about a file is trusted until invalidate() is called for it, e.g. from file system
+    events, and the lookups of cached pages don't touch the file system. The files in the `unwatched` folders,
+    that have no file system events, are always checked.
+    """
+    cache: DiskCache
+    memory: MemoryCache
+    fingerprint: str
+
+    def __init__(
+        self,
+        path: str,
+        fingerprint: str = "",
+        memory_size: int = 0,
+        max_entries: int = 10000,
+        max_size: int = 256 * 1024 * 1024,
+        eviction_policy: str = "lru",
+        verify: bool = True,
+    ):
+        self.cache = DiskCache(path, max_entries, max_size, eviction_policy)
+        self.memory = MemoryCache(memory_size)
+        self.fingerprint = fingerprint
+        self.flights = SingleFlight()
+        self.verify = verify
+        self.unwatched: List[str] = []
+        # absolute md_file_path -> (mtime_ns, size, key), avoids re-hashing unchanged files
+        self._keys: Dict[str, Tuple[int, int, str]] = {}
+        # page keys whose dependencies were checked since they last changed, and dependency -> those page keys
+        self._checked_pages: Set[str] = set()
+        self._dependents: Dict[str, Set[str]] = {}
+        # bumped by each invalidation, so what was read before an invalidation is not remembered after it
+        self._generation = 0
+
+    def stamp(self, md_file_path: str) -> Optional[Tuple[str, float]]:
+        """
+        Returns the content addressed cache key and the modification time of a markdown file,
+        or None if it can't be read.
+        """
+        path = os.path.abspath(md_file_path)
+        known = self._keys.get(path)
+        if known and not self.verify and self.is_watched(path):
+            return known[2], known[0] / 1e9
+        generation = self._generation
+        try:
+            st = os.stat(path)
+            if known and known[0] == st.st_mtime_ns and known[1] == st.st_size:
+                return known[2], known[0] / 1e9
+            with open(path, "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        key = self.content_key(content)
+        if generation == self._generation:
+            self._keys[path] = (st.st_mtime_ns, st.st_size, key)
+        return key, st.st_mtime_ns / 1e9
+
+    def is_watched(self, path: str) -> bool:
+        """
+        Returns whether changes of a file (absolute path) are reported by invalidate() when `verify` is not set.
+        """
+        return not any(path.startswith(os.path.join(os.path.abspath(folder), "")) for folder in self.unwatched)
+
+    def content_key(self, content: bytes) -> str:
+        hasher = sha256(self.fingerprint.encode("utf-8"))
+        hasher.update(content)
+        return hasher.hexdigest()
+
+    def is_current(self, key: Optional[str], md_file_path: str) -> bool:
+        """
+        Returns whether a markdown file still has the content of a cache key, reading it again.
+        Used after a render, as the file may have been saved between its stamp and its conversion.
+        """
+        try:
+            with open(md_file_path, "rb") as f:
+                return key is not None and self.content_key(f.read()) == key
+        except OSError:
+            return False
+
+    def key(self, md_file_path: str) -> Optional[str]:
+        """
+        Returns the content addressed cache key of a markdown file, or None if it can't be read.
+        """
+        stamp = self.stamp(md_file_path)
+        return None if stamp is None else stamp[0]
+
+    def invalidate(self, path: str):
+        """
+        Forgets what is known about a changed file (a page or a file that pages depend on),
+        or about all the files under a changed folder.
+        """
+        path = os.path.abspath(path)
+        prefix = os.path.join(path, "")
+        self._generation += 1
+        if self._keys.pop(path, None) is None:
+            for known in [p for p in list(self._keys) if p.startswith(prefix)]:
+                self._keys.pop(known, None)
+        for dependency in [p for p in list(self._dependents) if p == path or p.startswith(prefix)]:
+            self._checked_pages.difference_update(self._dependents.pop(dependency, ()))
+
+    def invalidate_dependencies(self):
+        """
+        Checks the dependencies of all the pages again on their next lookup.
+        """
+        self._generation += 1
+        self._dependents.clear()
+        self._checked_pages.clear()
+
+    def _checked(self, page_key: str, dependencies: Dict[str, Optional[List[int]]], generation: int):
+        if generation != self._generation:
+            return
+        if not all(self.is_watched(os.path.abspath(dependency)) for dependency in dependencies):
+            return
+        for dependency in dependencies:
+            self._dependents.setdefault(os.path.abspath(dependency), set()).add(page_key)
+        self._checked_pages.add(page_key)
+
+    def has(self, key: Optional[str]) -> bool:
+        return key is not None and key in self.cache
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        content = self.memory.get(key)
+        if content is not None:
+            return content
+        content = self.cache.get(key)
+        if content is not None:
+            self.memory.set(key, content)
+        return content
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        content = self.memory.get(key)
+        if content is not None:
+            return content
+        content = self.cache.get_bytes(key)
+        if content is not None:
+            self.memory.set(key, content)
+        return content
+
+    def set(self, key: Optional[str], content: Union[str, bytes]):
+        if key is None:
+            return
+        self.cache.set(key, content)
+        self.memory.set(key, content)
+
+    def get_or_render(self, key: Optional[str], md_file_path: str, render: Callable[[], str]) -> str:
+        """
+        Returns the cached entry, or renders and caches it.
+        Concurrent renders of the same page are coalesced into a single call of `render`.
+        The render is only cached if the file wasn't changed in the meantime, it is returned either way.
+        """
+        def render_once() -> str:
+            # a render of this page may have completed between the caller's lookup and now
+            content = self.get(key)
+            if content is None:
+                content = render()
+                if self.is_current(key, md_file_path):
+                    self.set(key, content)
+            return content
+
+        # keyed by version: a request for a newer version of the page doesn't join the render of an older one
+        return self.flights.do(key or md_file_path, render_once)
+
+    @staticmethod
+    def page_key(key: Optional[str]) -> Optional[str]:
+        """
+        Returns the key of the final html of a page (after the 'process_html' plugins) from its cache key.
+        """
+        if key is None:
+            return None
+        return sha256(f"page:{key}".encode("utf-8")).hexdigest()
+
+    def get_page(self, key: Optional[str]) -> Tuple[Optional[str], Optional[Dict[str, Optional[List[int]]]]]:
+        """
+        Returns the cached final html of a page and the stamps of the files it depends on,
+        or (None, None) if it's missing or one of those files changed.
+        """
+        page_key = self.page_key(key)
+        entry = self.get(page_key)
+        if entry is None:
+            return None, None
+        header, html = entry.split("\n", 1)
+        dependencies = json.loads(header)
+        if self.verify or page_key not in self._checked_pages:
+            generation = self._generation
+            if file_stamps(dependencies) != dependencies:
+                return None, None
+            self._checked(page_key, dependencies, generation)
+        return html, dependencies
+
+    def set_page(self, key: Optional[str], html: str, dependencies: Dict[str, Optional[List[int]]]):
+        """
+        Caches the final html of a page.
+        :param dependencies: file_stamps() of the files the html depends on, taken before reading them
+        """
+        self.set(self.page_key(key), json.dumps(dependencies) + "\n" + html)
+
+    def get_response(self, etag: str, encoding: str, render: Callable[[], str]) -> bytes:
+        """
+        Returns the body of a page response compressed with `encoding`.
+        The compressed body is cached by ETag, so each version of a page is compressed only once per encoding.
+        The ETag must identify the whole representation (page, template and their state), not only the source.
+        """
+        key = sha256(f"response:{encoding}:{etag}".encode("utf-8")).hexdigest()
+        body = self.get_bytes(key)
+        if body is None:
+            body = compress(render().encode("utf-8"), encoding)
+            self.set(key, body)
+        return body
 
-    def set(self, key: str, content: str):
-        self.cache.set(key, content, timeout=0)
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"memory": self.memory.stats(), "disk": self.cache.stats(), "renders": self.flights.stats()}
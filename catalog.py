@@ -0,0 +1,241 @@
+import os
+import posixpath
+from bisect import bisect_left, insort
+from collections import namedtuple
+from hashlib import sha256
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+# path: relative to the wiki directory (e.g. "folder/page.md"), folder: "" for the root of the wiki,
+# title: page name without the extension, mtime: seconds, hash: sha256 of the content,
+# mtime_ns: to tell whether the file changed since it was read
+Page = namedtuple("Page", "path folder title size mtime hash mtime_ns")
+# a subfolder in a listing, pages: number of pages in it and its subfolders, mtime: last modification of those pages
+Folder = namedtuple("Folder", "path name pages mtime")
+
+# 'name': a-z, 'mtime': most recently modified first
+SORT_MODES = ("name", "mtime")
+
+
+class PageCatalog:
+    """
+    Class that keeps an in-memory catalog of the *.md pages of the wiki.
+    It is built with a single os.scandir pass and kept current with update() (file system events and saves),
+    so listing the pages doesn't touch the file system.
+
+    The direct children of each folder are kept sorted by name and by last modification, the sorted indexes
+    are only rebuilt after a change.
+
+    The titles and paths of the pages are kept in a sorted prefix index for the completion of page names,
+    it is updated in place on each change.
+
+    With `verify` set (no file system events available), the catalog is scanned again on each query,
+    only the pages whose size or modification time changed are read again.
+    """
+    wiki_directory: str
+    excluded: List[str]
+    verify: bool
+
+    def __init__(self, wiki_directory: str, excluded: Iterable[str] = (), verify: bool = True):
+        """
+        :param excluded: folders of the wiki (relative, e.g. ".git" or "img") whose files are not pages
+        """
+        self.wiki_directory = wiki_directory
+        # the wiki itself (".", "") or a folder outside of it is never excluded
+        self.excluded = [folder for folder in (posixpath.normpath(folder.strip("/")) for folder in excluded)
+                         if folder not in (".", "..") and not folder.startswith("../")]
+        self.verify = verify
+        self._pages: Optional[Dict[str, Page]] = None
+        # (folder, sort mode) -> subfolders and pages of the folder, built on demand and dropped on change
+        self._indexes: Optional[Dict[Tuple[str, str], List[Union[Folder, Page]]]] = None
+        # sorted (casefolded title or path without the extension, page path), for complete()
+        self._prefixes: List[Tuple[str, str]] = []
+        self._lock = Lock()
+
+    def is_excluded(self, rel_path: str) -> bool:
+        return any(rel_path == folder or rel_path.startswith(folder + "/") for folder in self.excluded)
+
+    def rel_path(self, path: str) -> Optional[str]:
+        """
+        Returns the path relative to the wiki directory, or None if it's outside the wiki or excluded.
+        """
+        rel_path = os.path.relpath(os.path.abspath(path), os.path.abspath(self.wiki_directory))
+        rel_path = rel_path.replace(os.sep, "/")
+        if rel_path == "." or rel_path.startswith("../") or rel_path == ".." or self.is_excluded(rel_path):
+            return None
+        return rel_path
+
+    def file_path(self, page: Page) -> str:
+        return os.path.join(self.wiki_directory, page.path)
+
+    def _read(self, rel_path: str, st: os.stat_result, known: Optional[Page] = None) -> Optional[Page]:
+        if known is not None and known.mtime_ns == st.st_mtime_ns and known.size == st.st_size:
+            return known
+        try:
+            with open(os.path.join(self.wiki_directory, rel_path), "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        folder, filename = os.path.split(rel_path)
+        title, _ = os.path.splitext(filename)
+        return Page(rel_path, folder, title, st.st_size, st.st_mtime, sha256(content).hexdigest(), st.st_mtime_ns)
+
+    def _scan(self, rel_folder: str, pages: Dict[str, Page], known: Optional[Dict[str, Page]] = None):
+        """
+        Adds the pages of a folder and its subfolders to `pages`, the `known` pages that didn't change are reused.
+        """
+        try:
+            entries = list(os.scandir(os.path.join(self.wiki_directory, rel_folder)))
+        except OSError:
+            return
+        for entry in entries:
+            rel_path = f"{rel_folder}/{entry.name}" if rel_folder else entry.name
+            if self.is_excluded(rel_path):
+                continue
+            try:
+                if entry.is_dir():
+                    self._scan(rel_path, pages, known)
+                elif os.path.splitext(entry.name)[1].lower() == ".md":
+                    page = self._read(rel_path, entry.stat(), known.get(rel_path) if known else None)
+                    if page is not None:
+                        pages[rel_path] = page
+            except OSError:
+                continue
+
+    @staticmethod
+    def _prefix_keys(page: Page) -> set:
+        return {page.title.casefold(), os.path.splitext(page.path)[0].casefold()}
+
+    def scan(self):
+        """
+        Builds the catalog from the files of the wiki, or brings it up to date.
+        """
+        pages = {}
+        self._scan("", pages, self._pages)
+        with self._lock:
+            if pages == self._pages:
+                # nothing changed, the sorted indexes are kept
+                return
+            self._pages = pages
+            self._indexes = None
+            self._prefixes = sorted((key, page.path) for page in pages.values() for key in self._prefix_keys(page))
+
+    def update(self, path: str):
+        """
+        Updates the catalog after a change of a file or a folder of the wiki (creation, modification or removal).
+        """
+        rel_path = self.rel_path(path)
+        if rel_path is None or self._pages is None:
+            return
+        full_path = os.path.join(self.wiki_directory, rel_path)
+        pages = {}
+        if os.path.isdir(full_path):
+            # the pages of the folder that didn't change are not read again
+            self._scan(rel_path, pages, self._pages)
+        elif os.path.splitext(rel_path)[1].lower() == ".md":
+            try:
+                page = self._read(rel_path, os.stat(full_path))
+            except OSError:
+                page = None
+            if page is not None:
+                pages[rel_path] = page
+        with self._lock:
+            prefix = rel_path + "/"
+            for known in [p for p in self._pages if p == rel_path or p.startswith(prefix)]:
+                for key in self._prefix_keys(self._pages.pop(known)):
+                    i = bisect_left(self._prefixes, (key, known))
+                    if i < len(self._prefixes) and self._prefixes[i] == (key, known):
+                        del self._prefixes[i]
+            for page in pages.values():
+                for key in self._prefix_keys(page):
+                    insort(self._prefixes, (key, page.path))
+            self._pages.update(pages)
+            self._indexes = None
+
+    def _current(self) -> Dict[str, Page]:
+        if self.verify or self._pages is None:
+            self.scan()
+        return self._pages
+
+    def pages(self, folder: str = "") -> List[Page]:
+        """
+        Returns the pages in a folder of the wiki and its subfolders, all the pages by default.
+        """
+        folder = folder.strip("/")
+        pages = list(self._current().values())
+        if not folder:
+            return pages
+        return [page for page in pages if page.folder == folder or page.folder.startswith(folder + "/")]
+
+    def _build_indexes(self, pages: Dict[str, Page]) -> Dict[Tuple[str, str], List[Union[Folder, Page]]]:
+        direct_pages: Dict[str, List[Page]] = {"": []}
+        subfolders: Dict[str, set] = {"": set()}
+        counts: Dict[str, int] = {}
+        mtimes: Dict[str, float] = {}
+        for page in pages.values():
+            direct_pages.setdefault(page.folder, []).append(page)
+            folder = page.folder
+            while folder:
+                parent = posixpath.dirname(folder)
+                subfolders.setdefault(parent, set()).add(folder)
+                counts[folder] = counts.get(folder, 0) + 1
+                mtimes[folder] = max(mtimes.get(folder, 0), page.mtime)
+                folder = parent
+
+        indexes = {}
+        for folder in set(direct_pages) | set(subfolders):
+            folders = [Folder(f, posixpath.basename(f), counts[f], mtimes[f]) for f in subfolders.get(folder, ())]
+            folder_pages = direct_pages.get(folder, [])
+            # folders first, then pages
+            indexes[(folder, "name")] = (sorted(folders, key=lambda f: f.name.casefold()) +
+                                         sorted(folder_pages, key=lambda p: p.title.casefold()))
+            indexes[(folder, "mtime")] = (sorted(folders, key=lambda f: f.mtime, reverse=True) +
+                                          sorted(folder_pages, key=lambda p: p.mtime, reverse=True))
+        return indexes
+
+    def children(self, folder: str = "", sort: str = "name") -> List[Union[Folder, Page]]:
+        """
+        Returns the direct subfolders and pages of a folder, subfolders first, sorted following `sort`.
+        The returned list is shared and must not be modified.
+        """
+        if sort not in SORT_MODES:
+            raise ValueError(f"Unknown sort mode '{sort}', expected one of {SORT_MODES}")
+        self._current()
+        with self._lock:
+            if self._indexes is None:
+                self._indexes = self._build_indexes(self._pages)
+            return self._indexes.get((folder.strip("/"), sort), [])
+
+    def complete(self, prefix: str, limit: int = 10, where: Optional[Callable[[Page], bool]] = None) -> List[Page]:
+        """
+        Returns the pages whose title or path (e.g. "folder/pa") starts with a prefix, case insensitive,
+        sorted by the matched title or path.
+        :param where: only the pages for which it returns True are returned
+        """
+        prefix = prefix.strip().strip("/").casefold()
+        if not prefix or limit <= 0:
+            return []
+        self._current()
+        with self._lock:
+            pages, seen = [], set()
+            for i in range(bisect_left(self._prefixes, (prefix,)), len(self._prefixes)):
+                key, path = self._prefixes[i]
+                if not key.startswith(prefix):
+                    break
+                page = self._pages.get(path)
+                if path in seen or page is None or (where is not None and not where(page)):
+                    continue
+                seen.add(path)
+                pages.append(page)
+                if len(pages) >= limit:
+                    break
+            return pages
+
+    def get(self, path: str) -> Optional[Page]:
+        """
+        Returns the page of a file, e.g. get("folder/page.md").
+        """
+        return self._current().get(path.strip("/"))
+
+    def __len__(self) -> int:
+        return len(self._current())
@@ -28,6 +28,7 @@ IMAGES_FILE_MODE = '600'
 IMAGES_CLEANUP = False
 
 HIDE_FOLDER_IN_WIKI = []
+LIST_PAGE_SIZE = 100
 
 PLUGINS = []
 UNPROTECTED_ROUTES = []
@@ -43,7 +44,24 @@ IMAGE_ALLOWED_MIME_DEFAULT = ["image/gif", "image/jpeg", "image/png", "image/svg
 OPTIMIZE_IMAGES_DEFAULT = "no"
 
 CACHE_DIR = "/dev/shm/wikmd/cache"
+CACHE_MEMORY_SIZE = 64 * 1024 * 1024  # bytes
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_SIZE = 256 * 1024 * 1024  # bytes
+CACHE_EVICTION_POLICY = "lru"
+CACHE_WARMUP = True
+CACHE_WARMUP_WORKERS = 2
+CACHE_WARMUP_DELAY = 0  # seconds
+CACHE_INVALIDATION = "events"
+
+RENDER_BACKEND = "workers"
+RENDER_WORKERS = 2
 SEARCH_DIR = "/dev/shm/wikmd/searchindex"
+SEARCH_INDEX_PROCS = os.cpu_count() or 1
+SEARCH_INDEX_MEMORY = 128  # MB
+SEARCH_FLUSH_INTERVAL = 0.5  # seconds
+SEARCH_SUGGEST_BELOW = 3
+SEARCH_CACHE_SIZE = 256
+SEARCH_CONTENT_STORAGE = "full"
 
 
 def config_list(yaml_config, config_item_name, default_value):
@@ -102,7 +120,12 @@ class WikmdConfig:
         self.images_file_mode = os.getenv("IMAGES_FILE_MODE") or yaml_config["images_file_mode"] or IMAGES_FILE_MODE
         self.images_cleanup = os.getenv("IMAGES_CLEANUP") or yaml_config["images_cleanup"] or IMAGES_CLEANUP
 
-        self.hide_folder_in_wiki = os.getenv("hide_folder_in_wiki")or yaml_config["hide_folder_in_wiki"] or HIDE_FOLDER_IN_WIKI
+        # a comma separated list, also read from the lowercase variable of the previous versions
+        hide_folder_in_wiki = os.getenv("hide_folder_in_wiki") or config_list(yaml_config, "HIDE_FOLDER_IN_WIKI", HIDE_FOLDER_IN_WIKI)
+        if isinstance(hide_folder_in_wiki, str):
+            hide_folder_in_wiki = hide_folder_in_wiki.split(",")
+        self.hide_folder_in_wiki = [folder.strip() for folder in hide_folder_in_wiki if folder.strip()]
+        self.list_page_size = int(os.getenv("LIST_PAGE_SIZE") or yaml_config["list_page_size"] or LIST_PAGE_SIZE)
 
         self.plugins = os.getenv("WIKI_PLUGINS")or yaml_config["plugins"] or PLUGINS
 
@@ -115,4 +138,22 @@ class WikmdConfig:
         self.optimize_images = os.getenv("OPTIMIZE_IMAGES") or yaml_config["optimize_images"] or OPTIMIZE_IMAGES_DEFAULT
 
         self.cache_dir = os.getenv("CACHE_DIR") or yaml_config["cache_dir"] or CACHE_DIR
+        self.cache_memory_size = int(os.getenv("CACHE_MEMORY_SIZE") or yaml_config["cache_memory_size"] or CACHE_MEMORY_SIZE)
+        self.cache_max_entries = int(os.getenv("CACHE_MAX_ENTRIES") or yaml_config["cache_max_entries"] or CACHE_MAX_ENTRIES)
+        self.cache_max_size = int(os.getenv("CACHE_MAX_SIZE") or yaml_config["cache_max_size"] or CACHE_MAX_SIZE)
+        self.cache_eviction_policy = (os.getenv("CACHE_EVICTION_POLICY") or yaml_config["cache_eviction_policy"] or CACHE_EVICTION_POLICY).lower()
+        cache_warmup = os.getenv("CACHE_WARMUP") or yaml_config["cache_warmup"]
+        self.cache_warmup = CACHE_WARMUP if cache_warmup is None else str(cache_warmup) in ["True", "true", "Yes", "yes", "1"]
+        self.cache_warmup_workers = int(os.getenv("CACHE_WARMUP_WORKERS") or yaml_config["cache_warmup_workers"] or CACHE_WARMUP_WORKERS)
+        self.cache_warmup_delay = float(os.getenv("CACHE_WARMUP_DELAY") or yaml_config["cache_warmup_delay"] or CACHE_WARMUP_DELAY)
+        self.cache_invalidation = (os.getenv("CACHE_INVALIDATION") or yaml_config["cache_invalidation"] or CACHE_INVALIDATION).lower()
+
+        self.render_backend = (os.getenv("RENDER_BACKEND") or yaml_config["render_backend"] or RENDER_BACKEND).lower()
+        self.render_workers = int(os.getenv("RENDER_WORKERS") or yaml_config["render_workers"] or RENDER_WORKERS)
         self.search_dir = os.getenv("SEARCH_DIR") or yaml_config["search_dir"] or SEARCH_DIR
+        self.search_index_procs = int(os.getenv("SEARCH_INDEX_PROCS") or yaml_config["search_index_procs"] or SEARCH_INDEX_PROCS)
+        self.search_index_memory = int(os.getenv("SEARCH_INDEX_MEMORY") or yaml_config["search_index_memory"] or SEARCH_INDEX_MEMORY)
+        self.search_suggest_below = int(os.getenv("SEARCH_SUGGEST_BELOW") or yaml_config["search_suggest_below"] or SEARCH_SUGGEST_BELOW)
+        self.search_cache_size = int(os.getenv("SEARCH_CACHE_SIZE") or yaml_config["search_cache_size"] or SEARCH_CACHE_SIZE)
+        self.search_content_storage = (os.getenv("SEARCH_CONTENT_STORAGE") or yaml_config["search_content_storage"] or SEARCH_CONTENT_STORAGE).lower()
+        self.search_flush_interval = float(os.getenv("SEARCH_FLUSH_INTERVAL") or yaml_config["search_flush_interval"] or SEARCH_FLUSH_INTERVAL)
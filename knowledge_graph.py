@@ -1,66 +1,179 @@
 import os
 import re
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set
 from urllib.parse import unquote
 
-from config import WikmdConfig
-
-cfg = WikmdConfig()
-
-
-def extend_ids(links):
-    for link in links:
-        for l in link["links"]:
-            for i in links:
-                if i["path"] == l["filename"]:
-                    l["id"] = i["id"]
-    return links
-
-
-def find_links():
-    links = []
-    # regex for links (excluding images)
-    pattern = r'[^!]\[(.+?)\]\((.+?)\)'
-    id = 1
-    # walk through all files
-    for root, subfolder, files in os.walk(cfg.wiki_directory):
-        for item in files:
-            pagename, _ = os.path.splitext(item)
-            path = os.path.join(root, item)
-            value = {
-                "id": id,
-                "pagename": pagename,
-                "path": path[len(cfg.wiki_directory)+1:-len(".md")],
-                "weight": 0,
-                "links": [],
-            }
-            id += 1
-            if os.path.join(cfg.wiki_directory, '.git') in str(path):
-                # We don't want to search there
-                continue
-            if os.path.join(cfg.wiki_directory, cfg.images_route) in str(path):
-                # Nothing interesting there too
-                continue
-            with open(os.path.join(root, item), encoding="utf8", errors='ignore') as f:
-                fin = f.read()
-                print("--------------------")
-                print("filename: ", pagename)
-                try:
-                    for match in re.finditer(pattern, fin):
-                        description, url = match.groups()
-                        # only show files that are in the wiki. Not external sites.
-                        if url.startswith("/"):
-                            url = url[1:]
-                        url = unquote(url)
-                        if os.path.exists(os.path.join(cfg.wiki_directory, f"{url}.md")):
-                            info = {
-                                "filename": url,
-                            }
-                            value["links"].append(info)
-                            print(url)
-                            
-                except Exception as e:
-                    print("error: ", e)
-                
-            links.append(value)
-    links = extend_ids(links)
-    return links
+from catalog import Page, PageCatalog
+
+# regex for links (excluding images)
+LINK_PATTERN = re.compile(r'[^!]\[(.+?)\]\((.+?)\)')
+
+
+def page_key(page: Page) -> str:
+    """
+    Returns the key of a page in the graph: its path without the extension, e.g. "folder/page".
+    """
+    return os.path.splitext(page.path)[0]
+
+
+def page_links(text: str) -> Set[str]:
+    """
+    Function that returns the targets of the links of a page, as page keys. External links are kept,
+    they are only dropped when the graph is read.
+    """
+    targets = set()
+    for _, url in LINK_PATTERN.findall(text):
+        if url.startswith("/"):
+            url = url[1:]
+        targets.add(unquote(url))
+    return targets
+
+
+class KnowledgeGraph:
+    """
+    Class that keeps the links between the pages of the wiki: the forward edges (the pages a page links to)
+    and the back edges (the pages linking to a page), keyed by page path without the extension.
+
+    It is built from the page catalog once and kept current with update() (saves and file system events),
+    which only reads the pages whose content changed. With `catalog.verify` set (no file system events available),
+    it is brought up to date with the catalog on each query.
+    """
+    catalog: PageCatalog
+
+    def __init__(self, catalog: PageCatalog):
+        self.catalog = catalog
+        self._pages: Optional[Dict[str, Page]] = None
+        # page -> targets of its links, including the pages that don't exist (yet)
+        self._targets: Dict[str, Set[str]] = {}
+        # target -> pages linking to it
+        self._backlinks: Dict[str, Set[str]] = {}
+        # ids used by the graph view, a page keeps its id until it is removed
+        self._ids: Dict[str, int] = {}
+        self._next_id = 1
+        self._links: Optional[List[dict]] = None
+        self._lock = Lock()
+        # one sync at a time: the pages to read are chosen from the state the previous sync left
+        self._sync_lock = Lock()
+
+    def _read(self, page: Page) -> Set[str]:
+        try:
+            with open(self.catalog.file_path(page), encoding="utf8", errors='ignore') as f:
+                return page_links(f.read())
+        except OSError:
+            return set()
+
+    def _sync(self, pages: Iterable[Page], rel_path: Optional[str] = None):
+        """
+        Brings the graph up to date with the pages of the catalog under `rel_path` (a page or a folder,
+        the whole wiki by default), only the new and modified pages are read.
+        """
+        current = {page_key(page): page for page in pages}
+        with self._sync_lock:
+            known = self._pages or {}
+            changed = {key: self._read(page) for key, page in current.items()
+                       if key not in known or known[key].hash != page.hash}
+
+            with self._lock:
+                if self._pages is None:
+                    self._pages = {}
+                prefix = f"{rel_path}/"
+                removed = [key for key, page in self._pages.items() if key not in current and
+                           (rel_path is None or page.path == rel_path or page.path.startswith(prefix))]
+                for key in removed:
+                    self._set(key, set())
+                    del self._pages[key]
+                    del self._ids[key]
+                for key, targets in changed.items():
+                    self._set(key, targets)
+                    if key not in self._ids:
+                        self._ids[key] = self._next_id
+                        self._next_id += 1
+                self._pages.update(current)
+                if removed or changed:
+                    self._links = None
+
+    def _set(self, key: str, targets: Set[str]):
+        for target in self._targets.get(key, set()) - targets:
+            self._backlinks[target].discard(key)
+            if not self._backlinks[target]:
+                del self._backlinks[target]
+        for target in targets:
+            self._backlinks.setdefault(target, set()).add(key)
+        if targets:
+            self._targets[key] = targets
+        else:
+            self._targets.pop(key, None)
+
+    def scan(self):
+        """
+        Builds the graph from the pages of the catalog, or brings it up to date.
+        """
+        self._sync(self.catalog.pages())
+
+    def update(self, path: str):
+        """
+        Updates the graph after a change of a file or a folder of the wiki (creation, modification or removal),
+        once the catalog has been updated.
+        """
+        rel_path = self.catalog.rel_path(path)
+        if rel_path is None or self._pages is None:
+            return
+        page = self.catalog.get(rel_path)
+        self._sync([page] if page is not None else self.catalog.pages(rel_path), rel_path)
+
+    def _current(self) -> Dict[str, Page]:
+        if self.catalog.verify or self._pages is None:
+            self.scan()
+        return self._pages
+
+    def links_from(self, key: str) -> List[str]:
+        """
+        Returns the pages a page links to, e.g. links_from("folder/page").
+        """
+        pages = self._current()
+        with self._lock:
+            return sorted(target for target in self._targets.get(key, ()) if target in pages)
+
+    def links_to(self, key: str) -> List[str]:
+        """
+        Returns the pages linking to a page.
+        """
+        self._current()
+        with self._lock:
+            return sorted(self._backlinks.get(key, ()))
+
+    def links(self) -> List[dict]:
+        """
+        Returns the pages with their links for the graph view: id, pagename, path, weight and links (filename, id).
+        The returned list is shared and must not be modified.
+        """
+        self._current()
+        with self._lock:
+            if self._links is None:
+                self._links = [{
+                    "id": self._ids[key],
+                    "pagename": page.title,
+                    "path": key,
+                    "weight": 0,
+                    "links": [{"filename": target, "id": self._ids[target]}
+                              for target in sorted(self._targets.get(key, ())) if target in self._pages],
+                } for key, page in sorted(self._pages.items())]
+            return self._links
+
+    def page(self, id: int) -> Optional[str]:
+        """
+        Returns the page of an id of the graph view.
+        """
+        self._current()
+        with self._lock:
+            return next((key for key, page_id in self._ids.items() if page_id == id), None)
+
+
+def find_links(catalog: PageCatalog) -> List[dict]:
+    """
+    Function that builds the graph of the pages of the catalog from scratch and returns its links.
+    """
+    graph = KnowledgeGraph(catalog)
+    graph.scan()
+    return graph.links()
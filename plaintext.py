@@ -0,0 +1,177 @@
+import html
+import re
+from typing import List
+
+import yaml
+
+_META = re.compile(r"^[A-Za-z0-9_-]+:\s*")
+_YAML_DELIMITER = re.compile(r"^-{3}\s*$")
+_YAML_END = re.compile(r"^(-{3}|\.{3})\s*$")
+_FENCE = re.compile(r"^\s*(`{3,}|~{3,})")
+_INDENTED = re.compile(r"^( {4}|\t)")
+_COMMENT = re.compile(r"<!--.*?-->", re.S)
+_CODE_SPAN = re.compile(r"(`+)(.+?)\1")
+_AUTOLINK = re.compile(r"<((?:https?|ftp)://[^>\s]+|[^>\s@]+@[^>\s@]+)>")
+_TAG = re.compile(r"</?[A-Za-z][^>]*>")
+_IMAGE = re.compile(r"!\[[^\]]*\]\([^)]*\)")
+_LINK = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+_REF_LINK = re.compile(r"\[([^\]]+)\]\s?\[[^\]]*\]")
+_LINK_DEF = re.compile(r"^\s{0,3}\[(?!\^)[^\]]+\]:\s*\S+.*$")
+_FOOTNOTE_REF = re.compile(r"\[\^[^\]]+\](?!:)")
+_FOOTNOTE_DEF = re.compile(r"^\s{0,3}\[\^[^\]]+\]:\s*")
+_ABBR_DEF = re.compile(r"^\s{0,3}\*\[[^\]]+\]:.*$")
+_ATTR_LIST = re.compile(r"\s*\{:?\s*[#.][^}]*\}\s*$")
+_HEADING = re.compile(r"^\s{0,3}#{1,6}\s*|\s+#+\s*$")
+_SETEXT_OR_RULE = re.compile(r"^\s{0,3}([=\-*_])(\s*\1){2,}\s*$")
+_TABLE_RULE = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+_QUOTE = re.compile(r"^\s*(>\s?)+")
+_LIST = re.compile(r"^\s*([-*+]|\d+[.)])\s+")
+_DEFINITION = re.compile(r"^:\s+")
+_EMPHASIS = re.compile(r"\*{1,3}|(?<!\w)_{1,3}|_{1,3}(?!\w)|~~")
+_ESCAPE = re.compile(r"\\([\\`*_{}\[\]()#+\-.!|>])")
+_PIPES = re.compile(r"\s*\|\s*")
+
+
+def _inline(text: str) -> str:
+    if "<" in text:
+        text = _TAG.sub("", _AUTOLINK.sub(r"\1", text))
+    if "[" in text:
+        text = _REF_LINK.sub(r"\1", _LINK.sub(r"\1", _IMAGE.sub("", text)))
+        text = _FOOTNOTE_REF.sub("", text)
+    text = _EMPHASIS.sub("", text)
+    if "\\" in text:
+        text = _ESCAPE.sub(r"\1", text)
+    if "&" in text:
+        text = html.unescape(text)
+    return text
+
+
+def _inline_line(line: str) -> str:
+    # the content of code spans is literal
+    parts, last = [], 0
+    for m in _CODE_SPAN.finditer(line):
+        parts.append(_inline(line[last:m.start()]))
+        parts.append(m.group(2).strip())
+        last = m.end()
+    parts.append(_inline(line[last:]))
+    return "".join(parts)
+
+
+def _skip_meta(lines: List[str]) -> List[str]:
+    # meta-data (the "meta" markdown extension): "key: value" lines or a YAML block at the start of the page
+    if lines and _YAML_DELIMITER.match(lines[0]):
+        for i in range(1, len(lines)):
+            if _YAML_END.match(lines[i]):
+                return lines[i + 1:]
+        return lines
+    if lines and _META.match(lines[0]):
+        i = 0
+        while i < len(lines) and lines[i].strip() and (_META.match(lines[i]) or lines[i].startswith("    ")):
+            i += 1
+        return lines[i:]
+    return lines
+
+
+def page_tags(text: str) -> List[str]:
+    """
+    Function that returns the tags of a page, from the `tags` (or `tag`) entry of its meta-data:
+    a list or a comma separated string, in a YAML block or in "key: value" lines.
+    """
+    lines = text.lstrip("\ufeff").split("\n", 100)[:100]
+    header = lines[:len(lines) - len(_skip_meta(lines))]
+    if not header:
+        return []
+    if _YAML_DELIMITER.match(header[0]):
+        try:
+            meta = yaml.safe_load("\n".join(header[1:-1]))
+        except yaml.YAMLError:
+            return []
+    else:
+        meta, key = {}, None
+        for line in header:
+            if _META.match(line):
+                key, _, value = line.partition(":")
+                meta[key.strip().lower()] = value.strip()
+            elif key is not None:
+                meta[key.strip().lower()] += " " + line.strip()
+    if not isinstance(meta, dict):
+        return []
+    tags = meta.get("tags", meta.get("tag"))
+    if isinstance(tags, str):
+        tags = tags.split(",")
+    if not isinstance(tags, list):
+        return []
+    return [str(tag).strip() for tag in tags if tag is not None and str(tag).strip()]
+
+
+def markdown_to_text(text: str) -> str:
+    """
+    Function that converts markdown to the plain text that gets indexed for search.
+    Instead of rendering the page to html and parsing it back (Markdown + BeautifulSoup), the markdown syntax is
+    stripped line by line with regular expressions. The result has the same words as the text of the rendered page
+    (headings, emphasis, links, images, lists, tables, code, footnotes, meta-data, html), which is what matters for
+    search and for the highlights of the results.
+    """
+    lines = _skip_meta(_COMMENT.sub("", text).splitlines())
+    out = []
+    # consecutive lines that are not code, their inline syntax is stripped at once
+    chunk = []
+    fence = None
+    previous_blank, in_code, in_list = True, False, False
+
+    def literal(line: str):
+        if chunk:
+            out.append(_inline_line("\n".join(chunk)))
+            chunk.clear()
+        out.append(line)
+
+    for line in lines:
+        m = _FENCE.match(line)
+        if fence:
+            if m and m.group(1)[0] == fence[0] and len(m.group(1)) >= len(fence):
+                fence = None
+            else:
+                literal(line)
+            continue
+        if m:
+            fence = m.group(1)
+            continue
+
+        # indented code blocks, but not the continuation of list items
+        stripped = line.strip()
+        blank = not stripped
+        indented = _INDENTED.match(line) is not None
+        if indented and not blank and (in_code or (previous_blank and not in_list)):
+            in_code = True
+            literal(stripped)
+            continue
+        first = stripped[:1]
+        if not blank:
+            in_code = False
+            if (first in "-*+" or first.isdigit()) and _LIST.match(line):
+                in_list = True
+            elif previous_blank and not indented:
+                in_list = False
+        previous_blank = blank
+
+        # block syntax, the regular expressions only run on the lines that can match
+        if first in "[*=-_|:" and (_LINK_DEF.match(line) or _ABBR_DEF.match(line) or _SETEXT_OR_RULE.match(line) or
+                                   _TABLE_RULE.match(line)):
+            continue
+        if first == "#":
+            line = _HEADING.sub("", line)
+        elif first == ">":
+            line = _QUOTE.sub("", line)
+        if first in "-*+" or first.isdigit():
+            line = _LIST.sub("", line)
+        elif first == ":":
+            line = _DEFINITION.sub("", line)
+        elif first == "[":
+            line = _FOOTNOTE_DEF.sub("", line)
+        if stripped.endswith("}"):
+            line = _ATTR_LIST.sub("", line)
+        if "|" in line:
+            line = _PIPES.sub(" ", line).strip()
+        chunk.append(line)
+    literal("")
+    return "\n".join(out).strip()
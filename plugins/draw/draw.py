@@ -35,6 +35,12 @@ class Plugin:
         """
         return self.search_in_html_for_draw(html)
 
+    def get_html_dependencies(self, html: str) -> list:
+        """
+        returns the drawing files that process_html reads for this html
+        """
+        return [os.path.join(self.this_location, "drawings", draw) for draw in re.findall(r"\[\[(draw_.*)\]\]", html)]
+
     def communicate_plugin(self, request):
         """
         communication from "/plug_com"
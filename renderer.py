@@ -0,0 +1,281 @@
+import copy
+import importlib
+import io
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from logging import Logger
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pypandoc
+from lxml.html.clean import Cleaner
+
+from cache import Cache
+
+PANDOC_EXTRA_ARGS = ["--mathjax"]
+PANDOC_FILTERS = ['pandoc-xnos']
+
+# pandoc filters that the rendering workers run in-process: filter command -> python modules, in order
+IN_PROCESS_FILTERS = {
+    "pandoc-xnos": ["pandoc_fignos", "pandoc_eqnos", "pandoc_tablenos", "pandoc_secnos"],
+}
+RENDER_BACKENDS = ("workers", "pandoc")
+
+# niceness of the cache warm-up workers, so they yield the CPU to the live requests
+WARMUP_NICENESS = 10
+
+
+def get_pandoc_version() -> str:
+    try:
+        return pypandoc.get_pandoc_version()
+    except OSError:
+        return ""
+
+
+def convert_to_html(md_file_path: str) -> str:
+    """
+    Function that converts a *.md file to cleaned html with pandoc.
+    It doesn't depend on the Flask app, so it can run in worker processes.
+    """
+    html = pypandoc.convert_file(md_file_path, "html5",
+                                 format='md', extra_args=PANDOC_EXTRA_ARGS, filters=PANDOC_FILTERS)
+    return Cleaner(forms=False).clean_html(html)
+
+
+_PLAIN_TYPES = (type(None), bool, int, float, str, list, dict, tuple, set)
+# state of a rendering worker: pandoc path and the filter modules with a snapshot of their initial globals
+_worker_pandoc: Optional[str] = None
+_worker_filters: Optional[List[Tuple[object, dict]]] = None
+
+
+def _load_filters() -> List[Tuple[object, dict]]:
+    """
+    Imports the in-process filters and takes a snapshot of their module level state.
+    The filters keep per document state (targets, counters, flags) in module globals, which are restored from
+    the snapshot before each document, as if the filter was started in a new process.
+    """
+    global _worker_pandoc, _worker_filters
+    if _worker_filters is None:
+        os.environ["PANDOC_VERSION"] = get_pandoc_version()
+        _worker_pandoc = pypandoc.get_pandoc_path()
+        modules = [importlib.import_module("pandocxnos.core")]
+        for pandoc_filter in PANDOC_FILTERS:
+            for name in IN_PROCESS_FILTERS[pandoc_filter]:
+                try:
+                    modules.append(importlib.import_module(name))
+                except ImportError:  # like pandoc-xnos, skip the filters that are not installed
+                    pass
+        _worker_filters = [
+            (module, {k: copy.deepcopy(v) for k, v in vars(module).items()
+                      if not k.startswith("__") and isinstance(v, _PLAIN_TYPES)})
+            for module in modules
+        ]
+    return _worker_filters
+
+
+def convert_to_html_in_process(md_file_path: str) -> str:
+    """
+    Function that converts a *.md file to cleaned html like convert_to_html, but runs the pandoc filters inside
+    the current process instead of starting a python interpreter per filter and per document.
+    Pandoc itself runs twice (markdown -> json and json -> html), which takes a few milliseconds.
+    """
+    if not all(f in IN_PROCESS_FILTERS for f in PANDOC_FILTERS):
+        return convert_to_html(md_file_path)
+
+    argv = sys.argv
+    # the filters parse the output format from the command line, some of them at import time
+    sys.argv = ["pandoc-filter", "html5"]
+    try:
+        filters = _load_filters()
+        ast = subprocess.run([_worker_pandoc, "--from", "markdown", "--to", "json", md_file_path],
+                             capture_output=True, check=True).stdout.decode("utf-8")
+        for module, state in filters:
+            vars(module).update(copy.deepcopy(state))
+        for module, _ in filters[1:]:
+            stdout = io.StringIO()
+            module.main(io.StringIO(ast), stdout)
+            ast = stdout.getvalue()
+    finally:
+        sys.argv = argv
+
+    html = subprocess.run([_worker_pandoc, "--from", "json", "--to", "html5"] + PANDOC_EXTRA_ARGS,
+                          input=ast.encode("utf-8"), capture_output=True, check=True).stdout.decode("utf-8")
+    return Cleaner(forms=False).clean_html(html)
+
+
+class Renderer:
+    """
+    Base class of the rendering backends, that convert a *.md file to cleaned html.
+    It keeps the timing of the renders.
+    """
+    # picklable conversion function, also used by the cache warm-up workers
+    convert = staticmethod(convert_to_html)
+
+    def __init__(self, logger: Optional[Logger] = None):
+        self.logger = logger
+        self.renders = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = 0.0
+        self._lock = Lock()
+
+    def render(self, md_file_path: str) -> str:
+        start = time.perf_counter()
+        failed = True
+        try:
+            html = self._render(md_file_path)
+            failed = False
+            return html
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.renders += 1
+                self.failures += failed
+                self.total_time += elapsed
+                self.max_time = max(self.max_time, elapsed)
+                self.last_time = elapsed
+            if self.logger:
+                self.logger.info(f"Rendered '{md_file_path}' in {elapsed * 1000:.0f} ms")
+
+    def _render(self, md_file_path: str) -> str:
+        return self.convert(md_file_path)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "renders": self.renders,
+                "failures": self.failures,
+                "total_ms": self.total_time * 1000,
+                "avg_ms": self.total_time * 1000 / self.renders if self.renders else 0.0,
+                "max_ms": self.max_time * 1000,
+                "last_ms": self.last_time * 1000,
+            }
+
+    def close(self):
+        pass
+
+
+class PandocRenderer(Renderer):
+    """
+    Rendering backend that starts pandoc, and a python interpreter for each filter, for every render.
+    """
+
+
+class WorkerPoolRenderer(Renderer):
+    """
+    Rendering backend with a pool of long-lived worker processes that run the pandoc filters in-process.
+    """
+    convert = staticmethod(convert_to_html_in_process)
+
+    def __init__(self, workers: int = 2, logger: Optional[Logger] = None):
+        super().__init__(logger)
+        self.workers = max(1, workers)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def _render(self, md_file_path: str) -> str:
+        try:
+            return self.pool.submit(self.convert, md_file_path).result()
+        except BrokenProcessPool:
+            # a worker died (e.g. killed by the OOM killer), start a fresh pool for the next renders
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            raise
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+def get_renderer(backend: str, workers: int = 2, logger: Optional[Logger] = None) -> Renderer:
+    """
+    Function that returns the rendering backend configured with `render_backend`.
+    """
+    if backend == "workers":
+        return WorkerPoolRenderer(workers, logger)
+    if backend == "pandoc":
+        return PandocRenderer(logger)
+    raise ValueError(f"Unknown render backend '{backend}', expected one of {RENDER_BACKENDS}")
+
+
+def _init_warmup_worker():
+    try:
+        os.nice(WARMUP_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+
+class CacheWarmer:
+    """
+    Class that pre-renders the wiki pages into the cache in the background.
+    The pandoc conversions run in a bounded pool of low priority processes, the 'process_before_cache_html' step
+    (`post_process`) runs in the calling process. Pages are rendered in the given order and the ones already
+    cached are skipped.
+    """
+
+    def __init__(self, cache: Cache, post_process: Callable[[str, str], str], logger: Logger,
+                 workers: int = 1, delay: float = 0, convert: Callable[[str], str] = convert_to_html):
+        self.cache = cache
+        self.post_process = post_process
+        self.convert = convert
+        self.logger = logger
+        self.workers = max(1, workers)
+        self.delay = delay
+        self.total = 0
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+        self.thread = None
+
+    def start(self, pages: List[Tuple[str, str]]):
+        """
+        Starts warming the cache in a background thread.
+        :param pages: list of (md_file_path, page_name), in the order they should be rendered
+        """
+        self.thread = Thread(target=self.run, args=(pages,), daemon=True)
+        self.thread.start()
+
+    def run(self, pages: List[Tuple[str, str]]):
+        start = time.time()
+        self.total = len(pages)
+        self.logger.info(f"Cache warm-up >>> {self.total} pages with {self.workers} worker(s) ...")
+        report_every = max(1, self.total // 10)
+
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_warmup_worker) as pool:
+            pending = {}
+            todo = iter(pages)
+            while True:
+                # keep at most one conversion in flight per worker instead of queueing the whole wiki at once
+                for md_file_path, page_name in todo:
+                    key = self.cache.key(md_file_path)
+                    if key is None or self.cache.has(key):
+                        self.skipped += 1
+                        continue
+                    future = pool.submit(self.convert, md_file_path)
+                    pending[future] = (key, md_file_path, page_name)
+                    if len(pending) >= self.workers:
+                        break
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key, md_file_path, page_name = pending.pop(future)
+                    try:
+                        html = future.result()
+                        self.cache.get_or_render(key, md_file_path, lambda: self.post_process(html, page_name))
+                        self.done += 1
+                    except Exception as e:
+                        self.failed += 1
+                        self.logger.error(f"Cache warm-up of '{md_file_path}' failed >>> {str(e)}")
+                    if (self.done + self.failed) % report_every == 0:
+                        self.logger.info(f"Cache warm-up >>> {self.progress()}")
+                    if self.delay:
+                        time.sleep(self.delay)
+
+        self.logger.info(f"Cache warm-up finished in {time.time() - start:.1f}s >>> {self.progress()}")
+
+    def progress(self) -> Dict[str, int]:
+        return {"total": self.total, "rendered": self.done, "skipped": self.skipped, "failed": self.failed}
@@ -1,37 +1,253 @@
 import os
+import posixpath
 import time
-from collections import namedtuple
-from multiprocessing import Process
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from hashlib import sha256
+from logging import Logger
+from multiprocessing import Process, Queue
 from pathlib import Path
-from typing import List, NamedTuple, Tuple
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 
-from bs4 import BeautifulSoup
-from markdown import Markdown
-from watchdog.events import FileSystemEventHandler, FileSystemEvent
+from watchdog.events import (
+    EVENT_TYPE_CREATED,
+    EVENT_TYPE_DELETED,
+    EVENT_TYPE_MODIFIED,
+    EVENT_TYPE_MOVED,
+    FileSystemEventHandler,
+    FileSystemEvent,
+)
 from watchdog.observers import Observer
+from watchdog.observers.api import BaseObserver, ObservedWatch
 from whoosh import index, query
-from whoosh.fields import SchemaClass, TEXT, ID
+from whoosh.automata.fsa import find_all_matches
+from whoosh.automata.lev import levenshtein_automaton
+from whoosh.fields import SchemaClass, TEXT, ID, STORED, DATETIME, KEYWORD
 from whoosh.highlight import SentenceFragmenter
-from whoosh.qparser import MultifieldParser
+from whoosh.qparser import FieldAliasPlugin, FieldsPlugin, GtLtPlugin, MultifieldParser, RangePlugin
+from whoosh.qparser.dateparse import DateParserPlugin, English
+from whoosh.searching import Searcher
+from whoosh.spelling import Corrector
 from whoosh.writing import AsyncWriter
 
+from plaintext import markdown_to_text, page_tags
+
 
 class SearchSchema(SchemaClass):
-    path: ID = ID(stored=True, unique=True)
+    path: ID = ID(stored=True)
     filename: ID = ID(stored=True)
+    # path of the page relative to the wiki directory (e.g. "folder/page.md"), the key of update_document
+    page: ID = ID(unique=True)
+    # the folder of the page and its parents (e.g. "ops,ops/runbooks"), so folder:ops also finds the subfolders
+    folder: KEYWORD = KEYWORD(commas=True, lowercase=True)
     title: TEXT = TEXT(stored=True)
-    content: TEXT = TEXT(stored=True)
+    content: TEXT = TEXT()
+    # tags of the meta-data of the page
+    tags: KEYWORD = KEYWORD(commas=True, lowercase=True, scorable=True)
+    modified: DATETIME = DATETIME(sortable=True)
+    # text of the page for the highlights, kept following CONTENT_STORAGE
+    text: STORED = STORED()
+    # modification time and sha256 of the indexed file, used to reconcile the index with the wiki on start
+    mtime: STORED = STORED()
+    hash: STORED = STORED()
 
 
 SearchResult = namedtuple("Result", "path filename title score highlights")
 
+# messages of the Watchdog to the wiki process: (WATCHDOG_STARTED, None), (WATCHDOG_FAILED, None)
+# or (WATCHDOG_CHANGED, path of a changed file or folder)
+WATCHDOG_STARTED = "started"
+WATCHDOG_FAILED = "failed"
+WATCHDOG_CHANGED = "changed"
+# events that change the content of the wiki (the others, like opening a file, are ignored)
+CHANGE_EVENTS = (EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED)
+# how the text of the pages is kept in the index for the highlights: stored (whoosh deflates the stored fields),
+# or not at all (the highlights of the results read the pages again)
+CONTENT_STORAGE = ("full", "none")
+# search results by relevance, or most recently modified first
+SEARCH_SORT_MODES = ("score", "mtime")
+# names of the fields in the query syntax, e.g. "tag:oncall in:ops changed:today"
+FIELD_ALIASES = {"tags": ["tag"], "folder": ["in"], "modified": ["changed", "date"]}
+# spelling suggestions are only computed for the searches with fewer results
+SUGGEST_BELOW = 3
+# a path that keeps changing is indexed anyway once it waited this many flush intervals
+MAX_FLUSH_DELAY = 10
+# seconds between two reports of the rate of file system events
+EVENT_RATE_INTERVAL = 60
+
+
+def page_key(path: str, filename: str) -> str:
+    """
+    Function that returns the unique key of a page in the index from its folder ("." for the root) and file name.
+    """
+    return filename if path in ("", ".") else posixpath.join(path.replace(os.sep, "/"), filename)
+
+
+def textify(text: str) -> str:
+    """
+    Function that converts markdown to the plain text that gets indexed.
+    """
+    return markdown_to_text(text)
+
+
+def folder_keywords(path: str) -> str:
+    """
+    Function that returns the value of the folder field of the pages of a folder: the folder and its parents.
+    """
+    if path in ("", "."):
+        return ""
+    parts = path.replace(os.sep, "/").strip("/").split("/")
+    return ",".join("/".join(parts[:i + 1]) for i in range(len(parts)))
+
+
+def page_document(path: str, filename: str, title: str, content: str, mtime: float = 0) -> Dict[str, object]:
+    """
+    Function that returns the fields of the search document of a page from its markdown.
+    :param path: folder of the page, relative to the wiki directory ("." for the root)
+    """
+    return dict(path=path, filename=filename, page=page_key(path, filename), folder=folder_keywords(path),
+                title=title, content=textify(content), tags=",".join(page_tags(content)),
+                modified=datetime.fromtimestamp(mtime), mtime=mtime, hash=sha256(content.encode("utf-8")).hexdigest())
+
+
+def read_document(wiki_directory: str, path: str, title: str, relpath: str) -> Dict[str, object]:
+    """
+    Function that reads and textifies a file into the fields of its search document.
+    It runs in the processes of Search.index_all.
+    """
+    fpath = os.path.join(wiki_directory, relpath, path)
+    with open(fpath, "rb") as f:
+        data = f.read()
+        mtime = os.fstat(f.fileno()).st_mtime
+    return page_document(relpath, path, title, data.decode("utf8"), mtime)
+
+
+def _read_documents(args: Tuple[str, List[Tuple[str, str, str]]]) -> List[Dict[str, object]]:
+    wiki_directory, files = args
+    return [read_document(wiki_directory, path, title, relpath) for path, title, relpath in files]
+
+
+class WordListCorrector(Corrector):
+    """
+    Class that suggests spelling corrections from the sorted words of a field, ranked by their frequency
+    like the corrector of a whoosh reader.
+    The words are found by walking the list with a Levenshtein automaton, which skips most of them
+    (whoosh's ListCorrector does the same, but its lookup skips over matching words).
+    """
+
+    def __init__(self, frequencies: Dict[str, float]):
+        self.words = sorted(frequencies)
+        self.frequencies = frequencies
+
+    @classmethod
+    def from_reader(cls, reader, fieldname: str) -> "WordListCorrector":
+        fieldobj = reader.schema[fieldname]
+        return cls({fieldobj.from_bytes(word): info.weight() for word, info in reader.iter_field(fieldname)})
+
+    def _lookup(self, word: str) -> Optional[str]:
+        # first word of the list that is greater than or equal to `word`
+        pos = bisect_left(self.words, word)
+        return self.words[pos] if pos < len(self.words) else None
+
+    def _suggestions(self, text, maxdist, prefix):
+        dfa = levenshtein_automaton(text, maxdist, prefix).to_dfa()
+        for suggestion in find_all_matches(dfa, self._lookup):
+            yield 0 - (maxdist + (1.0 / (self.frequencies.get(suggestion) or 1) * 0.5)), suggestion
+
+
+class ResultCache:
+    """
+    Class that implements an LRU cache of search results, bounded in number of entries.
+    The keys hold the generation of the index the results come from: when the index commits a new generation,
+    the entries of the older ones are dropped.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def key(term: str, page: int, sort: str, suggest_below: int, generation: int) -> tuple:
+        # only the white space is normalized, the operators of the query syntax (AND, OR, NOT) are case sensitive
+        return " ".join(term.split()), page, sort, suggest_below, generation
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key: tuple, results: tuple):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            generation = key[-1]
+            if self.generation is not None and generation < self.generation:
+                # a slow query of an older generation
+                return
+            if generation != self.generation:
+                self._entries.clear()
+                self.generation = generation
+            self._entries[key] = results
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
 
 class Search:
+    """
+    Class that indexes the wiki and searches it.
+    One instance can be shared by the threads of the wiki process: the searchers are long-lived and only
+    refreshed when the generation of the index changes (e.g. after a commit of the Watchdog process).
+    """
     _index: index
     _schema: SearchSchema
 
-    def __init__(self, index_path: str, create: bool = False):
+    # idle searchers kept open, more are opened when more threads search at the same time
+    MAX_IDLE_SEARCHERS = 8
+    _dateparser: Optional[English] = None
+
+    def __init__(self, index_path: str, create: bool = False, cache_size: int = 256,
+                 content_storage: str = "full", wiki_directory: Optional[str] = None):
+        """
+        :param cache_size: number of search results kept in memory, for the repeated queries
+        :param content_storage: how the text of the pages is kept in the index, one of CONTENT_STORAGE
+        :param wiki_directory: where the pages are read from for the highlights, when their text is not stored
+        """
+        if content_storage not in CONTENT_STORAGE:
+            raise ValueError(f"Unknown content storage '{content_storage}', expected one of {CONTENT_STORAGE}")
+        self.index_path = index_path
+        self.content_storage = content_storage
+        self.wiki_directory = wiki_directory
         self._schema = SearchSchema()
+        self.results = ResultCache(cache_size)
+        self._searchers: List[Searcher] = []
+        self._searchers_lock = Lock()
+        self.refreshes = 0
+        # (index generation, corrector over the words of the content) for the spelling suggestions
+        self._corrector: Optional[Tuple[int, Corrector]] = None
+        self._corrector_lock = Lock()
         if create:
             if not os.path.exists(index_path):
                 os.makedirs(index_path)
@@ -39,19 +255,134 @@ class Search:
         else:
             self._index = index.open_dir(index_path)
 
+    @classmethod
+    def open_or_create(cls, index_path: str, **kwargs) -> "Search":
+        """
+        Opens the persistent index, or creates it if it doesn't exist yet or was built with an older schema.
+        """
+        if index.exists_in(index_path):
+            search = cls(index_path, **kwargs)
+            if set(search._index.schema.names()) == set(search._schema.names()):
+                return search
+            search.close()
+        return cls(index_path, create=True, **kwargs)
+
     def textify(self, text: str) -> str:
-        md = Markdown(extensions=["meta", "extra"])
-        html = md.convert(text)
-        soup = BeautifulSoup(html, "html.parser")
-        return soup.get_text()
+        return textify(text)
+
+    def _document(self, document: Dict[str, object]) -> Dict[str, object]:
+        return dict(document, text=document["content"]) if self.content_storage == "full" else document
+
+    def text(self, fields: Dict[str, object]) -> str:
+        """
+        Returns the text of an indexed page for its highlights: from the index if it is stored there,
+        otherwise from the page itself.
+        """
+        text = fields.get("text")
+        if text is not None:
+            return text
+        if self.wiki_directory is None:
+            return ""
+        try:
+            with open(os.path.join(self.wiki_directory, fields.get("path"), fields.get("filename")), "rb") as f:
+                return textify(f.read().decode("utf-8"))
+        except (OSError, UnicodeDecodeError):
+            return ""
+
+    def size(self) -> int:
+        """
+        Returns the size of the index files in bytes.
+        """
+        return sum(os.path.getsize(os.path.join(self.index_path, name)) for name in os.listdir(self.index_path))
+
+    @contextmanager
+    def searcher(self) -> Iterator[Searcher]:
+        """
+        Checks out a searcher for the calling thread, up to date with the latest generation of the index.
+        A whoosh searcher is not thread-safe, so each one is used by a single thread at a time and put back
+        in the pool afterwards.
+        """
+        with self._searchers_lock:
+            searcher = self._searchers.pop() if self._searchers else None
+        if searcher is None:
+            searcher = self._index.searcher()
+        elif not searcher.up_to_date():
+            # reuses the readers of the unchanged segments and closes the old searcher
+            searcher = searcher.refresh()
+            self.refreshes += 1
+        try:
+            yield searcher
+        finally:
+            with self._searchers_lock:
+                if len(self._searchers) < self.MAX_IDLE_SEARCHERS:
+                    self._searchers.append(searcher)
+                    searcher = None
+            if searcher is not None:
+                searcher.close()
+
+    def corrector(self, searcher: Searcher) -> Corrector:
+        """
+        Returns the spelling corrector of the content, built once per generation of the index.
+        Unlike the corrector of a reader with several segments, it doesn't compare the term with every word.
+        """
+        generation = searcher.reader().generation()
+        with self._corrector_lock:
+            if self._corrector is None or self._corrector[0] != generation:
+                self._corrector = (generation, WordListCorrector.from_reader(searcher.reader(), "content"))
+            return self._corrector[1]
+
+    def suggest(self, term: str) -> List[str]:
+        """
+        Returns spelling suggestions for a search term.
+        """
+        with self.searcher() as searcher:
+            return self.corrector(searcher).suggest(term)
+
+    def parse(self, term: str) -> query.Query:
+        """
+        Parses a search term. Besides the words searched in the titles and the content of the pages, it can filter on
+        the fields: "title:backup", "folder:ops/runbooks" (or "in:"), "tag:oncall", and on the modification date with
+        "modified:" (or "changed:") followed by a date ("2024", "20240131"), a range ("[20240101 to 20240201]",
+        "[-1 month to now]", ">20240101") or a relative date ("today", "yesterday", "'this month'").
+        """
+        parser = MultifieldParser(["title", "content"], schema=self._schema)
+        parser.add_plugin(FieldAliasPlugin(FIELD_ALIASES))
+        parser.add_plugin(GtLtPlugin())
+        # the relative dates are relative to the time of the search, the date parser is built once
+        if Search._dateparser is None:
+            Search._dateparser = English()
+        parser.add_plugin(DateParserPlugin(basedate=datetime.now(), dateparser=Search._dateparser))
+        try:
+            return parser.parse(term)
+        except (ValueError, AttributeError):
+            # whoosh fails on some malformed dates, the whole term is searched as words instead
+            parser = MultifieldParser(["title", "content"], schema=self._schema)
+            parser.remove_plugin_class(FieldsPlugin)
+            parser.remove_plugin_class(RangePlugin)
+            return parser.parse(term)
 
     def search(
-        self, term: str, page: int
+        self, term: str, page: int, suggest_below: int = SUGGEST_BELOW, sort: str = "score"
     ) -> Tuple[List[NamedTuple], int, int, List[str]]:
-        query = MultifieldParser(["title", "content"], schema=self._schema).parse(term)
+        """
+        Searches the index, the results of the queries already made on the current generation come from memory,
+        except for the queries on the modification date.
+        :param suggest_below: spelling suggestions are only computed if there are fewer results than this
+        :param sort: one of SEARCH_SORT_MODES
+        """
+        if sort not in SEARCH_SORT_MODES:
+            raise ValueError(f"Unknown sort mode '{sort}', expected one of {SEARCH_SORT_MODES}")
+        key = self.results.key(term, page, sort, suggest_below, self._index.latest_generation())
+        cached = self.results.get(key)
+        if cached is not None:
+            return cached
+        query = self.parse(term)
         frag = SentenceFragmenter(maxchars=2000)
-        with self._index.searcher() as searcher:
-            res = searcher.search_page(query, page)
+        with self.searcher() as searcher:
+            if sort == "mtime":
+                res = searcher.search_page(query, page, sortedby="modified", reverse=True)
+            else:
+                res = searcher.search_page(query, page)
             res.fragmenter = frag
             results = [
                 SearchResult(
@@ -59,52 +390,154 @@ class Search:
                     r.get("filename"),
                     r.get("title"),
                     r.score,
-                    r.highlights("content"),
+                    r.highlights("content", text=self.text(r.fields())),
                 )
                 for r in res
             ]
-            corrector = searcher.corrector("content")
-            suggestions = corrector.suggest(term)
-        return results, res.total, res.pagecount, suggestions
+            suggestions = self.corrector(searcher).suggest(term) if res.total < suggest_below else []
+        found = results, res.total, res.pagecount, suggestions
+        # the dates are relative to the time of the search ("today", "[-1 month to now]"), their results are not kept
+        if not any(getattr(leaf, "fieldname", None) == "modified" for leaf in query.leaves()):
+            self.results.set(key, found)
+        return found
 
-    def index(self, path: str, filename: str, title: str, content: str):
+    def index(self, path: str, filename: str, title: str, content: str, mtime: float = 0):
         writer = AsyncWriter(self._index)
-        content = self.textify(content)
-        writer.add_document(path=path, filename=filename, title=title, content=content)
+        writer.update_document(**self._document(page_document(path, filename, title, content, mtime)))
         writer.commit()
 
     def delete(self, path: str, filename: str):
         writer = AsyncWriter(self._index)
-        q = query.And([query.Term("path", path), query.Term("filename", filename)])
-        writer.delete_by_query(q)
+        writer.delete_by_term("page", page_key(path, filename))
         writer.commit()
 
-    def index_all(self, wiki_directory: str, files: List[Tuple[str, str, str]]):
+    def apply(self, documents: Iterable[Dict[str, object]], deleted: Iterable[str] = (),
+              deleted_folders: Iterable[str] = ()):
+        """
+        Applies a batch of changes in a single writer transaction.
+        :param documents: fields of the new or changed pages, see read_document
+        :param deleted: keys of the removed pages, see page_key
+        :param deleted_folders: removed folders, relative to the wiki directory, with all their pages
+        """
         writer = AsyncWriter(self._index)
-        for path, title, relpath in files:
-            fpath = os.path.join(wiki_directory, relpath, path)
-            with open(fpath, encoding="utf8") as f:
-                content = f.read()
-            content = self.textify(content)
-            writer.add_document(
-                path=relpath, filename=path, title=title, content=content
-            )
+        for key in deleted:
+            writer.delete_by_term("page", key)
+        for folder in deleted_folders:
+            writer.delete_by_query(query.Prefix("page", folder.replace(os.sep, "/") + "/"))
+        for document in documents:
+            writer.update_document(**self._document(document))
         writer.commit()
 
+    def index_all(self, wiki_directory: str, files: List[Tuple[str, str, str]], procs: int = 1, limitmb: int = 128):
+        """
+        Indexes files of the wiki.
+        With several `procs`, the files are read and textified in a pool of processes that feed a single writer.
+        :param files: (filename, title, relpath) of the files
+        :param limitmb: memory of the writer in MB, before it flushes a segment to disk
+        """
+        writer = AsyncWriter(self._index, writerargs={"limitmb": limitmb})
+        if procs <= 1 or len(files) <= 1:
+            for path, title, relpath in files:
+                writer.add_document(**self._document(read_document(wiki_directory, path, title, relpath)))
+        else:
+            # batches amortize the inter-process communication, several batches per process balance the load
+            size = max(1, min(64, len(files) // (procs * 4)))
+            batches = [(wiki_directory, files[i:i + size]) for i in range(0, len(files), size)]
+            with ProcessPoolExecutor(max_workers=procs) as pool:
+                for documents in pool.map(_read_documents, batches):
+                    for document in documents:
+                        writer.add_document(**self._document(document))
+        writer.commit()
+
+    def reconcile(self, wiki_directory: str, files: List[Tuple[str, str, str, str]],
+                  procs: int = 1, limitmb: int = 128) -> Tuple[int, int]:
+        """
+        Brings the persistent index up to date with the wiki: only the new files and the files whose content hash
+        changed since they were indexed are indexed again (a file that was only touched is not), the removed files
+        are deleted.
+        :param files: (filename, title, relpath, sha256 of the content) of all the pages of the wiki
+        :return: number of indexed and deleted files
+        """
+        with self._index.searcher() as searcher:
+            indexed = {(fields.get("path"), fields.get("filename")): fields.get("hash")
+                       for fields in searcher.all_stored_fields()}
+
+        changed, current = [], set()
+        for path, title, relpath, content_hash in files:
+            current.add((relpath, path))
+            if indexed.get((relpath, path)) != content_hash:
+                changed.append((path, title, relpath))
+        stale = [key for key in indexed if key not in current]
+
+        writer = AsyncWriter(self._index)
+        for relpath, path in stale + [(relpath, path) for path, _, relpath in changed]:
+            writer.delete_by_term("page", page_key(relpath, path))
+        writer.commit()
+        if changed:
+            self.index_all(wiki_directory, changed, procs, limitmb)
+        return len(changed), len(stale)
+
     def close(self):
+        with self._searchers_lock:
+            searchers, self._searchers = self._searchers, []
+        for searcher in searchers:
+            searcher.close()
         self._index.close()
 
 
 class Watchdog(FileSystemEventHandler):
+    """
+    Class that keeps the search index up to date with the wiki from file system events, in its own process.
+    The changed paths are collected and debounced: a path is indexed once it didn't change for `flush_interval`
+    seconds, and all the paths ready at a flush are applied in a single writer transaction.
+
+    The `excluded` folders (e.g. .git or the images) are not watched at all, so their events are not even
+    generated: the folders that contain an excluded folder are watched on their own, and their other
+    subfolders recursively.
+    """
     wiki_directory: str
     search_directory: str
     search: Search
     proc: Process
+    events: Optional[Queue]
+    flush_interval: float
 
-    def __init__(self, wiki_directory: str, search_directory: str):
+    def __init__(self, wiki_directory: str, search_directory: str, events: Optional[Queue] = None,
+                 flush_interval: float = 0.5, logger: Optional[Logger] = None, excluded: Iterable[str] = (),
+                 content_storage: str = "full"):
+        """
+        :param events: queue that receives the changed paths, used to invalidate the cache of the wiki process
+        :param flush_interval: seconds between two flushes of the pending changes to the index
+        :param excluded: folders of the wiki (relative, e.g. ".git" or "img") that are not watched
+        :param content_storage: how the text of the pages is kept in the index, one of CONTENT_STORAGE
+        """
         self.wiki_directory = Path(wiki_directory).absolute()
         self.search_directory = search_directory
-        self.search = Search(self.search_directory)
+        self.search = Search(self.search_directory, content_storage=content_storage)
+        self.events = events
+        self.flush_interval = flush_interval
+        self.logger = logger
+        # the wiki itself (".", "") or a folder outside of it is never excluded
+        self.excluded = [folder for folder in (posixpath.normpath(folder.strip("/")) for folder in excluded)
+                         if folder not in (".", "..") and not folder.startswith("../")]
+        self._observer: Optional[BaseObserver] = None
+        # watched folder -> its watch, and the folders that are watched without their subfolders
+        self._watches: Dict[str, ObservedWatch] = {}
+        self._split: Set[str] = set()
+        self.events_seen = 0
+        self.events_ignored = 0
+        self.event_rate = 0.0
+        self._rate_start = time.monotonic()
+        self._rate_events = 0
+        # path -> (is a directory, time of the first event, time of the last event) of the changes to index
+        self._pending: Dict[str, Tuple[bool, float, float]] = {}
+        self._pending_lock = Lock()
+        self.batches = 0
+        self.changes = 0
+        self.max_batch = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
 
     def rel_path(self, path: str):
         base_path = Path(path)
@@ -114,49 +547,199 @@ class Watchdog(FileSystemEventHandler):
         else:
             return str(rel_path)
 
-    def on_created(self, event: FileSystemEvent):
-        # Switch to dest_path if it exists because it means move
-        file_path = event.src_path
-        if hasattr(event, "dest_path"):
-            file_path = event.dest_path
+    def is_excluded(self, path: str) -> bool:
+        rel_path = self.rel_path(path).replace(os.sep, "/")
+        return any(rel_path == folder or rel_path.startswith(folder + "/") for folder in self.excluded)
 
-        if not os.path.splitext(file_path)[1].lower() == ".md":
+    def schedule(self, observer: BaseObserver, folder: str):
+        """
+        Watches a folder of the wiki, without its excluded subfolders.
+        """
+        folder = os.path.abspath(folder)
+        if self.is_excluded(folder) or folder in self._watches:
             return
+        rel_path = self.rel_path(folder).replace(os.sep, "/")
+        prefix = "" if rel_path == "." else rel_path + "/"
+        if not any(excluded.startswith(prefix) for excluded in self.excluded):
+            self._watches[folder] = observer.schedule(self, folder, recursive=True)
+            return
+        self._watches[folder] = observer.schedule(self, folder, recursive=False)
+        self._split.add(folder)
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                self.schedule(observer, entry.path)
+
+    def unschedule(self, observer: BaseObserver, folder: str):
+        """
+        Stops watching a removed folder and its subfolders.
+        """
+        prefix = os.path.join(folder, "")
+        for path in [p for p in self._watches if p == folder or p.startswith(prefix)]:
+            self._split.discard(path)
+            try:
+                observer.unschedule(self._watches.pop(path))
+            except KeyError:
+                pass
+
+    def _count_event(self, ignored: bool):
+        self.events_seen += 1
+        self.events_ignored += ignored
+        self._rate_events += 1
+
+    def report_event_rate(self, now: Optional[float] = None):
+        """
+        Updates the rate of the file system events, and logs it every EVENT_RATE_INTERVAL seconds.
+        """
+        now = time.monotonic() if now is None else now
+        elapsed = now - self._rate_start
+        if elapsed < EVENT_RATE_INTERVAL:
+            return
+        self.event_rate = self._rate_events / elapsed
+        if self.logger and self._rate_events:
+            self.logger.info(f"Watchdog >>> {self.event_rate:.1f} events/s, "
+                             f"{self.events_ignored} of {self.events_seen} events ignored")
+        self._rate_start, self._rate_events = now, 0
+
+    def dispatch(self, event: FileSystemEvent):
+        if event.event_type not in CHANGE_EVENTS:
+            self._count_event(True)
+            return
+        paths = [event.src_path]
+        # Also index dest_path if it exists because it means move
+        if getattr(event, "dest_path", ""):
+            paths.append(event.dest_path)
+        paths = [path for path in paths if not self.is_excluded(path)]
+        self._count_event(not paths)
 
+        # new folders in a folder that is watched on its own need a watch of their own
+        if event.is_directory and self._observer is not None and event.event_type != EVENT_TYPE_MODIFIED:
+            for path in paths:
+                if os.path.dirname(path) in self._split:
+                    if os.path.isdir(path):
+                        self.schedule(self._observer, path)
+                    else:
+                        self.unschedule(self._observer, path)
+
+        # a modified folder only means that its entries changed, they have events of their own
+        if event.is_directory and event.event_type == EVENT_TYPE_MODIFIED:
+            return
+        for path in paths:
+            if self.events is not None:
+                self.events.put((WATCHDOG_CHANGED, path))
+            if event.is_directory or os.path.splitext(path)[1].lower() == ".md":
+                self.queue(path, event.is_directory)
+
+    def queue(self, path: str, is_directory: bool = False, now: Optional[float] = None):
+        """
+        Adds a changed file or folder to the pending changes.
+        """
+        now = time.monotonic() if now is None else now
+        with self._pending_lock:
+            _, first, _ = self._pending.get(path, (is_directory, now, now))
+            self._pending[path] = (is_directory, first, now)
+
+    def _document(self, file_path: str) -> Optional[Dict[str, object]]:
         base_path, filename = os.path.split(file_path)
-        rel_path = self.rel_path(base_path)
         title, _ = os.path.splitext(filename)
-        with open(file_path, encoding="utf8") as f:
-            content = f.read()
-        self.search.index(rel_path, filename, title, content)
+        try:
+            return read_document(str(self.wiki_directory), filename, title, self.rel_path(base_path))
+        except (OSError, UnicodeDecodeError):
+            return None
 
-    def on_deleted(self, event: FileSystemEvent):
-        if not os.path.splitext(event.src_path)[1].lower() == ".md":
-            return
+    def flush(self, now: Optional[float] = None, force: bool = False) -> int:
+        """
+        Indexes the pending changes that are ready in one transaction.
+        :param force: also index the paths that changed during the last flush interval
+        :return: number of changed paths
+        """
+        now = time.monotonic() if now is None else now
+        with self._pending_lock:
+            ready = {path: change for path, change in self._pending.items()
+                     if force or now - change[2] >= self.flush_interval
+                     or now - change[1] >= self.flush_interval * MAX_FLUSH_DELAY}
+            for path in ready:
+                del self._pending[path]
+        if not ready:
+            return 0
 
-        base_path, filename = os.path.split(event.src_path)
-        rel_path = self.rel_path(base_path)
-        self.search.delete(rel_path, filename)
+        files, deleted_folders = set(), set()
+        for path, (is_directory, _, _) in ready.items():
+            if not is_directory:
+                files.add(path)
+            elif os.path.isdir(path):
+                # a folder created or moved into the wiki, its pages may not have events of their own
+                for root, _, names in os.walk(path):
+                    files.update(os.path.join(root, name) for name in names
+                                 if os.path.splitext(name)[1].lower() == ".md")
+            else:
+                deleted_folders.add(self.rel_path(path))
 
-    def on_moved(self, event: FileSystemEvent):
-        self.on_deleted(event)
-        self.on_created(event)
+        documents: Dict[str, Dict[str, object]] = {}
+        deleted = set()
+        for path in files:
+            document = self._document(path) if os.path.isfile(path) else None
+            if document is None:
+                deleted.add(page_key(*os.path.split(self.rel_path(path))))
+            else:
+                documents[document["page"]] = document
+        deleted -= set(documents)
+        self.search.apply(documents.values(), deleted, deleted_folders)
 
-    def on_modified(self, event: FileSystemEvent):
-        self.on_deleted(event)
-        self.on_created(event)
+        # lag: from the first event of a path to the flush that indexes it
+        lags = [now - first for _, first, _ in ready.values()]
+        self.batches += 1
+        self.changes += len(lags)
+        self.max_batch = max(self.max_batch, len(lags))
+        self.last_lag = max(lags)
+        self.max_lag = max(self.max_lag, self.last_lag)
+        self.total_lag += sum(lags)
+        if self.logger:
+            self.logger.info(f"Search index >>> {len(documents)} updated, {len(deleted)} deleted, "
+                             f"lag {self.last_lag * 1000:.0f} ms")
+        return len(lags)
+
+    def stats(self) -> Dict[str, float]:
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {
+            "batches": self.batches,
+            "changes": self.changes,
+            "pending": pending,
+            "avg_batch": self.changes / self.batches if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "avg_lag_ms": self.total_lag * 1000 / self.changes if self.changes else 0.0,
+            "max_lag_ms": self.max_lag * 1000,
+            "last_lag_ms": self.last_lag * 1000,
+            "events": self.events_seen,
+            "events_ignored": self.events_ignored,
+            "events_per_s": self.event_rate,
+        }
 
     def watchdog(self):
-        observer = Observer()
-        observer.schedule(self, self.wiki_directory, recursive=True)
-        observer.start()
+        observer = self._observer = Observer()
+        self.schedule(observer, str(self.wiki_directory))
+        try:
+            observer.start()
+        except OSError:
+            # e.g. the file system doesn't support inotify or the watch limit is reached
+            if self.events is not None:
+                self.events.put((WATCHDOG_FAILED, None))
+            raise
+        if self.events is not None:
+            self.events.put((WATCHDOG_STARTED, None))
         try:
             while observer.is_alive():
-                observer.join(1)
-                time.sleep(1)
+                observer.join(self.flush_interval)
+                self.flush()
+                self.report_event_rate()
         finally:
             observer.stop()
             observer.join()
+            self.flush(force=True)
 
     def start(self):
         try:
@@ -2,6 +2,12 @@ import wiki
 import pytest
 import pypandoc
 import os
+import gzip
+import queue
+import shutil
+import threading
+import time
+from unittest import mock
 
 from wiki import app
 
@@ -27,6 +33,33 @@ def test_list():
     #assert b'homepage.md' in rv.data
     assert b'Features.md' in rv.data
 
+
+def test_list_json():
+    os.makedirs("wiki/testing_folder_list0123/sub", exist_ok=True)
+    for path in ("wiki/testing_folder_list0123/b.md", "wiki/testing_folder_list0123/A.md",
+                 "wiki/testing_folder_list0123/sub/c.md"):
+        with open(path, "w") as f:
+            f.write("# page")
+
+    rv = app.test_client().get("/api/list")
+    assert rv.status_code == 200
+    folders = [e["folder"] for e in rv.json["entries"] if e["type"] == "folder"]
+    assert "testing_folder_list0123" in folders
+    # only the direct children are listed
+    assert "/testing_folder_list0123/b" not in [e["url"] for e in rv.json["entries"]]
+
+    rv = app.test_client().get("/api/list?folder=testing_folder_list0123&sort=name")
+    assert [e.get("doc") or e.get("name") for e in rv.json["entries"]] == ["sub", "A.md", "b.md"]
+    assert rv.json["entries"][0]["pages"] == 1
+    assert rv.json["total"] == 3
+
+    rv = app.test_client().get("/api/list?page=2x")
+    assert rv.status_code == 400
+    rv = app.test_client().get("/list/?page=abc")
+    assert rv.status_code == 200
+
+    shutil.rmtree("wiki/testing_folder_list0123")
+
 # creates a file and check if the content of the file is visible in the wiki
 def test_create_file_in_folder():
     # create dir if it does not exist
@@ -57,6 +90,52 @@ def test_search():
      assert b'result(s)' in rv.data
      assert b'Features' in rv.data
 
+     rv = app.test_client().get("/api/suggest?q=Featres")
+     assert rv.status_code == 200
+     assert "features" in rv.get_json()["suggestions"]
+
+def test_complete():
+    rv = app.test_client().get("/api/complete?q=feat")
+    assert rv.status_code == 200
+    assert {'title': "Features", 'url': "/Features", 'folder': ""} in rv.get_json()["completions"]
+
+    rv = app.test_client().get("/api/complete?q=feat&limit=x")
+    assert rv.status_code == 400
+
+def test_stats():
+    app.test_client().get("/Features")
+    rv = app.test_client().get("/api/stats")
+    assert rv.status_code == 200
+    assert {"memory", "disk", "renders"} <= set(rv.get_json()["cache"])
+    assert "renders" in rv.get_json()["renderer"]
+
+def test_invalidation_survives_errors():
+    events = queue.Queue()
+    thread = threading.Thread(target=wiki.invalidate_cache_on_events, args=(None, events), daemon=True)
+    wiki.cache.verify = wiki.catalog.verify = False
+    with mock.patch.object(wiki.catalog, "update", side_effect=KeyError("page")):
+        thread.start()
+        events.put((wiki.WATCHDOG_CHANGED, os.path.join(wiki.cfg.wiki_directory, "Features.md")))
+        for _ in range(100):
+            if wiki.cache.verify:
+                break
+            time.sleep(0.05)
+    # back to checking the files, and still handling the events
+    assert wiki.cache.verify and wiki.catalog.verify
+    assert thread.is_alive()
+    events.put((wiki.WATCHDOG_STARTED, None))
+    for _ in range(100):
+        if not wiki.cache.verify:
+            break
+        time.sleep(0.05)
+    assert not wiki.catalog.verify
+    wiki.cache.verify = wiki.catalog.verify = True
+
+def test_knowledge_graph():
+    rv = app.test_client().get("/knowledge-graph")
+    assert rv.status_code == 200
+    assert b'label: "Features"' in rv.data
+
 # create a new file using the wiki and check if it is visible in the wiki
 def test_new_file():
     rv = app.test_client().get("/add_new")
@@ -145,3 +224,95 @@ def test_edit_file_folder():
 
     os.remove("wiki/testingfolder01234/testing01234filenotexisting.md")
     os.removedirs("wiki/testingfolder01234")
+
+# checks that unchanged pages are answered with 304 Not Modified
+def test_conditional_requests():
+    f = open("wiki/testing01234conditional.md", "w+")
+    f.write("# this is the header\n extra content")
+    f.close()
+
+    rv = app.test_client().get("/testing01234conditional")
+    assert rv.status_code == 200
+    etag = rv.headers["ETag"]
+    last_modified = rv.headers["Last-Modified"]
+
+    rv = app.test_client().get("/testing01234conditional", headers={"If-None-Match": etag})
+    assert rv.status_code == 304
+    assert rv.data == b""
+
+    rv = app.test_client().get("/testing01234conditional", headers={"If-Modified-Since": last_modified})
+    assert rv.status_code == 304
+
+    # the theme is part of the page
+    app.test_client().get("/toggle-darktheme/")
+    rv = app.test_client().get("/testing01234conditional", headers={"If-None-Match": etag})
+    app.test_client().get("/toggle-darktheme/")
+    assert rv.status_code == 200
+
+    f = open("wiki/testing01234conditional.md", "w+")
+    f.write("# this is another header")
+    f.close()
+    rv = app.test_client().get("/testing01234conditional", headers={"If-None-Match": etag})
+    assert rv.status_code == 200
+    assert b'this is another header' in rv.data
+
+    os.remove("wiki/testing01234conditional.md")
+
+
+# pages with the same content and mtime are still different representations
+def test_conditional_requests_identical_pages():
+    for name in ("testing01234dupA", "testing01234dupB"):
+        with open(f"wiki/{name}.md", "w") as f:
+            f.write("# same content")
+        os.utime(f"wiki/{name}.md", (1000000000, 1000000000))
+
+    etag = app.test_client().get("/testing01234dupA").headers["ETag"]
+    rv = app.test_client().get("/testing01234dupB", headers={"If-None-Match": etag})
+    assert rv.status_code == 200
+    assert rv.headers["ETag"] != etag
+
+    for name in ("testing01234dupA", "testing01234dupB"):
+        os.remove(f"wiki/{name}.md")
+
+
+def test_precompressed_responses():
+    f = open("wiki/testing01234compressed.md", "w+")
+    f.write("# this is the header\n extra content")
+    f.close()
+
+    rv = app.test_client().get("/testing01234compressed", headers={"Accept-Encoding": "gzip"})
+    assert rv.status_code == 200
+    assert rv.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in rv.headers["Vary"]
+    assert b'this is the header' in gzip.decompress(rv.data)
+    etag = rv.headers["ETag"]
+
+    # served from the cache the second time
+    rv2 = app.test_client().get("/testing01234compressed", headers={"Accept-Encoding": "gzip"})
+    assert rv2.data == rv.data
+
+    rv = app.test_client().get("/testing01234compressed", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert rv.status_code == 304
+
+    rv = app.test_client().get("/testing01234compressed", headers={"If-None-Match": etag})
+    assert rv.status_code == 200
+    assert "Content-Encoding" not in rv.headers
+    assert b'this is the header' in rv.data
+
+    os.remove("wiki/testing01234compressed.md")
+
+
+# the compressed bodies of pages with the same content and mtime are not shared
+def test_precompressed_responses_identical_pages():
+    for name in ("testing01234zipA", "testing01234zipB"):
+        with open(f"wiki/{name}.md", "w") as f:
+            f.write("# same content")
+        os.utime(f"wiki/{name}.md", (1000000000, 1000000000))
+
+    for name in ("testing01234zipA", "testing01234zipB"):
+        rv = app.test_client().get(f"/{name}", headers={"Accept-Encoding": "gzip"})
+        assert rv.headers["Content-Encoding"] == "gzip"
+        assert f"<title>{name}".encode() in gzip.decompress(rv.data)
+
+    for name in ("testing01234zipA", "testing01234zipB"):
+        os.remove(f"wiki/{name}.md")
@@ -0,0 +1,299 @@
+import gzip
+import os
+import tempfile
+import threading
+import time
+
+from cache import Cache, DiskCache, MemoryCache, SingleFlight, file_stamps, render_fingerprint
+
+
+def write(path: str, content: str):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_cache_survives_restart():
+    tmpc, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    md = os.path.join(tmpd, "page.md")
+    write(md, "# page")
+
+    c = Cache(tmpc, render_fingerprint("2.19", ["--mathjax"]))
+    c.set(c.key(md), "<h1>page</h1>")
+
+    c = Cache(tmpc, render_fingerprint("2.19", ["--mathjax"]))
+    assert c.get(c.key(md)) == "<h1>page</h1>"
+
+
+def test_cache_invalidated_by_content_and_pipeline():
+    tmpc, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    md = os.path.join(tmpd, "page.md")
+    write(md, "# page")
+
+    c = Cache(tmpc, render_fingerprint("2.19", ["--mathjax"]))
+    c.set(c.key(md), "<h1>page</h1>")
+
+    write(md, "# changed")
+    assert c.get(c.key(md)) is None
+
+    write(md, "# page")
+    assert c.get(c.key(md)) == "<h1>page</h1>"
+
+    c = Cache(tmpc, render_fingerprint("3.1", ["--mathjax"]))
+    assert c.get(c.key(md)) is None
+
+
+def test_cache_missing_file():
+    c = Cache(tempfile.mkdtemp())
+    assert c.key("/does/not/exist.md") is None
+    assert c.get(None) is None
+
+
+def test_memory_cache_lru_by_bytes():
+    m = MemoryCache(10)
+    m.set("a", "aaaa")
+    m.set("b", "bbbb")
+    assert m.get("a") == "aaaa"  # a is now the most recently used
+    m.set("c", "cccc")
+    assert m.get("b") is None
+    assert m.get("a") == "aaaa"
+    assert m.get("c") == "cccc"
+
+    m.set("big", "x" * 11)  # larger than the whole tier, never stored
+    assert m.get("big") is None
+
+    stats = m.stats()
+    assert stats["bytes"] == 8
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 3
+    assert stats["misses"] == 2
+
+
+def test_cache_memory_tier_in_front_of_file_system():
+    tmpc, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    md = os.path.join(tmpd, "page.md")
+    write(md, "# page")
+
+    c = Cache(tmpc, memory_size=1024)
+    c.set(c.key(md), "<h1>page</h1>")
+    assert c.get(c.key(md)) == "<h1>page</h1>"
+    assert c.stats()["memory"]["hits"] == 1
+
+    # a fresh process starts with an empty memory tier and fills it from disk
+    c = Cache(tmpc, memory_size=1024)
+    assert c.get(c.key(md)) == "<h1>page</h1>"
+    assert c.stats()["memory"]["misses"] == 1
+    assert c.get(c.key(md)) == "<h1>page</h1>"
+    assert c.stats()["memory"]["hits"] == 1
+
+
+def key(n: int) -> str:
+    return f"{n:064x}"
+
+
+def test_disk_cache_lru_eviction():
+    d = DiskCache(tempfile.mkdtemp(), max_entries=10, max_bytes=1024, policy="lru")
+    for n in range(10):
+        d.set(key(n), "x")
+    assert d.get(key(0)) == "x"
+    d.set(key(10), "x")  # prunes down to 9 entries, least recently used first
+    assert d.stats()["entries"] == 9
+    assert d.stats()["evictions"] == 2
+    assert d.get(key(0)) == "x"
+    assert d.get(key(1)) is None
+    assert d.get(key(2)) is None
+
+
+def test_disk_cache_lfu_eviction():
+    d = DiskCache(tempfile.mkdtemp(), max_entries=10, max_bytes=1024, policy="lfu")
+    for n in range(10):
+        d.set(key(n), "x")
+    for n in range(1, 10):
+        d.get(key(n))
+    d.get(key(1))
+    d.set(key(10), "x")
+    assert d.stats()["entries"] == 9
+    assert d.get(key(0)) is None
+    assert d.get(key(2)) is None
+    assert d.get(key(10)) == "x"
+    assert d.get(key(1)) == "x"
+
+
+def test_disk_cache_bounded_in_bytes_and_reloaded():
+    tmpc = tempfile.mkdtemp()
+    d = DiskCache(tmpc, max_entries=100, max_bytes=100, policy="lru")
+    for n in range(5):
+        d.set(key(n), "y" * 30)
+    assert d.stats()["bytes"] <= 90
+    assert d.get(key(4)) == "y" * 30
+
+    d = DiskCache(tmpc, max_entries=100, max_bytes=100, policy="lru")
+    assert d.stats()["entries"] == len(os.listdir(tmpc))
+    assert d.get(key(4)) == "y" * 30
+
+
+def test_single_flight_coalesces_concurrent_renders():
+    tmpc, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    md = os.path.join(tmpd, "page.md")
+    write(md, "# page")
+    c = Cache(tmpc, memory_size=1024)
+    renders = []
+
+    def render():
+        renders.append(1)
+        time.sleep(0.2)
+        return "<h1>page</h1>"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(c.get_or_render(c.key(md), md, render)))
+        for _ in range(10)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(renders) == 1
+    assert results == ["<h1>page</h1>"] * 10
+    assert c.stats()["renders"]["calls"] + c.stats()["renders"]["coalesced"] == 10
+    assert c.get(c.key(md)) == "<h1>page</h1>"
+
+
+def test_render_of_changed_file_not_cached():
+    tmpc, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    md = os.path.join(tmpd, "page.md")
+    write(md, "# page")
+    c = Cache(tmpc, memory_size=1024)
+    key = c.key(md)
+
+    def render():
+        # saved while it is rendered
+        write(md, "# saved")
+        return "<h1>page</h1>"
+
+    assert c.get_or_render(key, md, render) == "<h1>page</h1>"
+    assert c.get(key) is None
+    assert not c.is_current(key, md)
+    c.invalidate(md)
+    assert c.is_current(c.key(md), md)
+
+
+def test_single_flight_per_page_version():
+    tmpc, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    md = os.path.join(tmpd, "page.md")
+    write(md, "# page")
+    c = Cache(tmpc, memory_size=1024)
+    old_key = c.key(md)
+    started = threading.Event()
+
+    def render_old():
+        started.set()
+        time.sleep(0.2)
+        return "<h1>page</h1>"
+
+    results = []
+    t = threading.Thread(target=lambda: results.append(c.get_or_render(old_key, md, render_old)))
+    t.start()
+    started.wait()
+    # saved while the old version is rendered
+    write(md, "# saved")
+    c.invalidate(md)
+    assert c.get_or_render(c.key(md), md, lambda: "<h1>saved</h1>") == "<h1>saved</h1>"
+    t.join()
+    assert results == ["<h1>page</h1>"]
+    assert c.get(c.key(md)) == "<h1>saved</h1>"
+
+
+def test_single_flight_shares_errors():
+    sf = SingleFlight()
+
+    def fail():
+        raise RuntimeError("pandoc died")
+
+    try:
+        sf.do("page", fail)
+        assert False
+    except RuntimeError:
+        pass
+    assert sf.stats()["in_flight"] == 0
+
+
+def test_page_cache_invalidated_by_dependencies():
+    tmpc, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    md, drawing = os.path.join(tmpd, "page.md"), os.path.join(tmpd, "draw_1")
+    write(md, "# page")
+    write(drawing, "<svg/>")
+    c = Cache(tmpc, memory_size=1024)
+    key = c.key(md)
+
+    c.set_page(key, "<h1>page</h1><svg/>", file_stamps([drawing]))
+    assert c.get_page(key) == ("<h1>page</h1><svg/>", file_stamps([drawing]))
+
+    write(drawing, "<svg>changed</svg>")
+    assert c.get_page(key) == (None, None)
+
+    c.set_page(key, "<h1>page</h1>", file_stamps([]))
+    assert c.get_page(key) == ("<h1>page</h1>", {})
+    assert c.get(key) is None  # the page entry doesn't shadow the pre-plugin html
+
+
+def test_cache_stores_compressed_responses():
+    c = Cache(tempfile.mkdtemp(), memory_size=1024)
+    renders = []
+
+    def render():
+        renders.append(1)
+        return "<h1>page</h1>"
+
+    body = c.get_response("etag", "gzip", render)
+    assert gzip.decompress(body) == b"<h1>page</h1>"
+    assert c.get_response("etag", "gzip", render) == body
+    assert len(renders) == 1
+
+
+def test_cache_invalidated_by_events():
+    tmpc, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    md, drawing = os.path.join(tmpd, "page.md"), os.path.join(tmpd, "draw_1")
+    write(md, "# page")
+    write(drawing, "<svg/>")
+    c = Cache(tmpc, memory_size=1024, verify=False)
+    key = c.key(md)
+    c.set_page(key, "<h1>page</h1><svg/>", file_stamps([drawing]))
+    assert c.get_page(key)[0] == "<h1>page</h1><svg/>"
+
+    # changes are not seen until they are reported
+    write(md, "# changed")
+    write(drawing, "<svg>changed</svg>")
+    assert c.key(md) == key
+    assert c.get_page(key)[0] == "<h1>page</h1><svg/>"
+
+    c.invalidate(md)
+    assert c.key(md) != key
+    c.invalidate(drawing)
+    assert c.get_page(key) == (None, None)
+
+    # a changed folder invalidates the files under it
+    new_key = c.key(md)
+    write(md, "# changed again")
+    c.invalidate(tmpd)
+    assert c.key(md) not in (key, new_key)
+
+    os.remove(md)
+    c.invalidate(md)
+    assert c.stamp(md) is None
+
+
+def test_cache_checks_unwatched_folders():
+    tmpc, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmpd, "hidden"))
+    md, hidden = os.path.join(tmpd, "page.md"), os.path.join(tmpd, "hidden", "page.md")
+    write(md, "# page")
+    write(hidden, "# hidden")
+    c = Cache(tmpc, memory_size=1024, verify=False)
+    c.unwatched = [os.path.join(tmpd, "hidden")]
+    key, hidden_key = c.key(md), c.key(hidden)
+
+    write(md, "# changed")
+    write(hidden, "# changed")
+    assert c.key(md) == key
+    assert c.key(hidden) != hidden_key
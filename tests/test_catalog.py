@@ -0,0 +1,146 @@
+import os
+import tempfile
+
+from catalog import PageCatalog
+
+
+def write(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def make_wiki() -> str:
+    tmpd = tempfile.mkdtemp()
+    write(os.path.join(tmpd, "homepage.md"), "# home")
+    write(os.path.join(tmpd, "folder", "page.md"), "# page")
+    write(os.path.join(tmpd, "folder", "sub", "deep.md"), "# deep")
+    write(os.path.join(tmpd, "folder", "notes.txt"), "not a page")
+    write(os.path.join(tmpd, ".git", "HEAD.md"), "not a page")
+    write(os.path.join(tmpd, "img", "readme.md"), "not a page")
+    return tmpd
+
+
+def test_catalog_scan():
+    tmpd = make_wiki()
+    c = PageCatalog(tmpd, [".git", "/img"])
+    assert sorted(p.path for p in c.pages()) == ["folder/page.md", "folder/sub/deep.md", "homepage.md"]
+    assert sorted(p.path for p in c.pages("folder/")) == ["folder/page.md", "folder/sub/deep.md"]
+    assert [p.path for p in c.pages("folder/sub")] == ["folder/sub/deep.md"]
+
+    page = c.get("folder/page.md")
+    assert page.folder == "folder"
+    assert page.title == "page"
+    assert page.size == len("# page")
+    assert page.mtime == os.path.getmtime(os.path.join(tmpd, "folder", "page.md"))
+    assert c.get("homepage.md").folder == ""
+
+
+def test_catalog_verify_reads_changed_pages_only():
+    tmpd = make_wiki()
+    c = PageCatalog(tmpd, [".git", "img"])
+    md = os.path.join(tmpd, "homepage.md")
+    page = c.get("homepage.md")
+    assert c.get("homepage.md") is page
+
+    # same size and modification time: not read again
+    st = os.stat(md)
+    write(md, "# HOME")
+    os.utime(md, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert c.get("homepage.md") is page
+
+    os.utime(md, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+    assert c.get("homepage.md").hash != page.hash
+
+
+def test_catalog_folder_update_reads_changed_pages_only():
+    tmpd = make_wiki()
+    c = PageCatalog(tmpd, [".git", "img"], verify=False)
+    c.scan()
+    page, deep = c.get("folder/page.md"), c.get("folder/sub/deep.md")
+
+    write(os.path.join(tmpd, "folder", "sub", "deep.md"), "# changed")
+    c.update(os.path.join(tmpd, "folder"))
+    assert c.get("folder/page.md") is page
+    assert c.get("folder/sub/deep.md").hash != deep.hash
+
+
+def test_catalog_never_excludes_the_wiki():
+    tmpd = make_wiki()
+    c = PageCatalog(tmpd, [".", "", ".git", "img/"])
+    assert c.excluded == [".git", "img"]
+    assert len(c) == 3
+
+
+def test_catalog_updates():
+    tmpd = make_wiki()
+    c = PageCatalog(tmpd, [".git", "img"], verify=False)
+    c.scan()
+    old_hash = c.get("homepage.md").hash
+
+    # nothing changes until the changes are reported
+    write(os.path.join(tmpd, "new.md"), "# new")
+    write(os.path.join(tmpd, "homepage.md"), "# changed")
+    assert c.get("new.md") is None
+    assert c.get("homepage.md").hash == old_hash
+
+    c.update(os.path.join(tmpd, "new.md"))
+    c.update(os.path.abspath(os.path.join(tmpd, "homepage.md")))
+    assert c.get("new.md").title == "new"
+    assert c.get("homepage.md").hash != old_hash
+
+    os.rename(os.path.join(tmpd, "folder"), os.path.join(tmpd, "moved"))
+    c.update(os.path.join(tmpd, "folder"))
+    c.update(os.path.join(tmpd, "moved"))
+    assert sorted(p.path for p in c.pages("moved")) == ["moved/page.md", "moved/sub/deep.md"]
+    assert c.pages("folder") == []
+
+    # excluded folders and files outside the wiki are ignored
+    write(os.path.join(tmpd, "img", "other.md"), "not a page")
+    c.update(os.path.join(tmpd, "img", "other.md"))
+    c.update(tempfile.mkdtemp())
+    assert len(c) == 4
+
+
+def test_catalog_children_presorted():
+    tmpd = make_wiki()
+    c = PageCatalog(tmpd, [".git", "img"], verify=False)
+    c.scan()
+    assert [e.path for e in c.children("", "name")] == ["folder", "homepage.md"]
+    assert c.children("folder", "name")[0].pages == 1
+    assert [e.path for e in c.children("folder", "name")] == ["folder/sub", "folder/page.md"]
+
+    os.utime(os.path.join(tmpd, "homepage.md"), (1, 1))
+    c.update(os.path.join(tmpd, "homepage.md"))
+    write(os.path.join(tmpd, "folder", "new.md"), "# new")
+    os.utime(os.path.join(tmpd, "folder", "new.md"), (2, 2))
+    c.update(os.path.join(tmpd, "folder", "new.md"))
+    assert [e.path for e in c.children("folder", "mtime")] == ["folder/sub", "folder/page.md", "folder/new.md"]
+    assert c.children("", "mtime")[0].pages == 3
+    assert c.children("missing") == []
+
+
+def test_catalog_complete():
+    tmpd = make_wiki()
+    write(os.path.join(tmpd, "Pages.md"), "# pages")
+    c = PageCatalog(tmpd, [".git", "img"], verify=False)
+    c.scan()
+    assert [p.path for p in c.complete("pa")] == ["folder/page.md", "Pages.md"]
+    assert [p.path for p in c.complete("FOLDER/")] == ["folder/page.md", "folder/sub/deep.md"]
+    assert [p.path for p in c.complete("folder/sub/d")] == ["folder/sub/deep.md"]
+    assert [p.path for p in c.complete("pa", limit=1)] == ["folder/page.md"]
+    assert [p.path for p in c.complete("pa", where=lambda p: p.folder == "")] == ["Pages.md"]
+    assert c.complete("") == []
+
+    # created, renamed and deleted pages
+    write(os.path.join(tmpd, "folder", "palette.md"), "# palette")
+    c.update(os.path.join(tmpd, "folder", "palette.md"))
+    assert [p.path for p in c.complete("pal")] == ["folder/palette.md"]
+    os.rename(os.path.join(tmpd, "folder", "sub"), os.path.join(tmpd, "folder", "other"))
+    c.update(os.path.join(tmpd, "folder", "sub"))
+    c.update(os.path.join(tmpd, "folder", "other"))
+    assert c.complete("folder/sub") == []
+    assert [p.path for p in c.complete("dee")] == ["folder/other/deep.md"]
+    os.remove(os.path.join(tmpd, "Pages.md"))
+    c.update(os.path.join(tmpd, "Pages.md"))
+    assert [p.path for p in c.complete("pa")] == ["folder/page.md", "folder/palette.md"]
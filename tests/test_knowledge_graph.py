@@ -0,0 +1,92 @@
+import os
+import tempfile
+
+from catalog import PageCatalog
+from knowledge_graph import KnowledgeGraph, find_links, page_links
+
+
+def write(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def make_wiki() -> str:
+    tmpd = tempfile.mkdtemp()
+    write(os.path.join(tmpd, "homepage.md"), "# home\n\nSee [a page](/folder/page) and [b](folder/b%20page).\n")
+    write(os.path.join(tmpd, "folder", "page.md"), "# page\n\nBack [home](/homepage), [out](https://example.com)\n")
+    write(os.path.join(tmpd, "folder", "b page.md"), "# b\n\nAn image ![img](/img/x.png)\n")
+    return tmpd
+
+
+def test_page_links():
+    assert page_links("text [a](/x/y) ![img](/img/i.png) [b](z%20w)") == {"x/y", "z w"}
+
+
+def test_knowledge_graph_links():
+    tmpd = make_wiki()
+    c = PageCatalog(tmpd, [".git", "img"], verify=False)
+    c.scan()
+    g = KnowledgeGraph(c)
+    g.scan()
+    assert g.links_from("homepage") == ["folder/b page", "folder/page"]
+    assert g.links_from("folder/page") == ["homepage"]
+    assert g.links_to("folder/page") == ["homepage"]
+
+    links = {link["path"]: link for link in g.links()}
+    assert sorted(links) == ["folder/b page", "folder/page", "homepage"]
+    assert [l["id"] for l in links["homepage"]["links"]] == [links["folder/b page"]["id"], links["folder/page"]["id"]]
+    assert g.page(links["folder/page"]["id"]) == "folder/page"
+    assert find_links(c) == g.links()
+
+
+def test_knowledge_graph_updates():
+    tmpd = make_wiki()
+    c = PageCatalog(tmpd, [".git", "img"], verify=False)
+    c.scan()
+    g = KnowledgeGraph(c)
+    g.scan()
+    links = g.links()
+    page_id = {link["path"]: link["id"] for link in links}["folder/page"]
+
+    # saved page
+    write(os.path.join(tmpd, "folder", "b page.md"), "# b\n\nNow links [home](/homepage)\n")
+    c.update(os.path.join(tmpd, "folder", "b page.md"))
+    g.update(os.path.join(tmpd, "folder", "b page.md"))
+    assert g.links_to("homepage") == ["folder/b page", "folder/page"]
+    assert g.links() is not links
+
+    # renamed page, the links to the old name are kept for when it comes back
+    os.rename(os.path.join(tmpd, "folder", "page.md"), os.path.join(tmpd, "folder", "moved.md"))
+    for path in ("page.md", "moved.md"):
+        c.update(os.path.join(tmpd, "folder", path))
+        g.update(os.path.join(tmpd, "folder", path))
+    assert g.links_from("homepage") == ["folder/b page"]
+    assert g.links_to("folder/page") == ["homepage"]
+    assert g.links_to("homepage") == ["folder/b page", "folder/moved"]
+    assert g.page(page_id) is None
+
+    # deleted folder
+    os.remove(os.path.join(tmpd, "folder", "moved.md"))
+    os.remove(os.path.join(tmpd, "folder", "b page.md"))
+    c.update(os.path.join(tmpd, "folder"))
+    g.update(os.path.join(tmpd, "folder"))
+    assert g.links_to("homepage") == []
+    assert [link["path"] for link in g.links()] == ["homepage"]
+    assert g.links()[0]["links"] == []
+
+
+def test_knowledge_graph_reads_changed_pages_only():
+    tmpd = make_wiki()
+    c = PageCatalog(tmpd, [".git", "img"])
+    g = KnowledgeGraph(c)
+    reads = []
+    read = g._read
+    g._read = lambda page: reads.append(page.path) or read(page)
+    g.links()
+    assert len(reads) == 3
+
+    # without file system events, the changes are found on the next query
+    write(os.path.join(tmpd, "new.md"), "# new\n\n[home](/homepage)\n")
+    assert g.links_to("homepage") == ["folder/page", "new"]
+    assert reads[3:] == ["new.md"]
@@ -35,4 +35,10 @@ def test_process_html():
     for plugin in wiki.plugins:
         if ("process_html" in dir(plugin)):
             html = plugin.process_html(html)
-    assert html == before
\ No newline at end of file
+    assert html == before
+
+def test_html_dependencies():
+    html = "<p>[[draw_1234]]</p>"
+    dependencies = wiki.html_dependencies(html)
+    assert dependencies is not None
+    assert any(d.endswith(os.path.join("drawings", "draw_1234")) for d in dependencies)
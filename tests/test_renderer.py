@@ -0,0 +1,46 @@
+import logging
+import os
+import tempfile
+
+from cache import Cache
+from renderer import CacheWarmer, PandocRenderer, WorkerPoolRenderer
+
+
+def test_cache_warmer():
+    tmpc, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    pages = []
+    for n in ("a", "b", "c"):
+        path = os.path.join(tmpd, f"{n}.md")
+        with open(path, "w") as f:
+            f.write(f"# page {n}")
+        pages.append((path, n))
+    c = Cache(tmpc, memory_size=1024)
+    c.set(c.key(pages[0][0]), "<h1>already cached</h1>")
+
+    warmer = CacheWarmer(c, lambda html, page_name: html + page_name, logging.getLogger(), workers=2)
+    warmer.start(pages)
+    warmer.thread.join(60)
+
+    assert warmer.progress() == {"total": 3, "rendered": 2, "skipped": 1, "failed": 0}
+    assert c.get(c.key(pages[0][0])) == "<h1>already cached</h1>"
+    assert "page b" in c.get(c.key(pages[1][0]))
+    assert c.get(c.key(pages[2][0])).endswith("c")
+
+
+def test_worker_pool_renderer_matches_pandoc():
+    tmpd = tempfile.mkdtemp()
+    path = os.path.join(tmpd, "figures.md")
+    with open(path, "w") as f:
+        f.write("# Title\n\n![A figure](a.png){#fig:one}\n\n![Another](b.png){#fig:two}\n\nSee @fig:two.\n")
+
+    pandoc, workers = PandocRenderer(), WorkerPoolRenderer(workers=1)
+    expected = pandoc.render(path)
+    # the filters state must not leak from one render to the next
+    assert workers.render(path) == expected
+    assert workers.render(path) == expected
+    workers.close()
+
+    assert "Figure\xa02" in expected
+    assert workers.stats()["renders"] == 2
+    assert workers.stats()["failures"] == 0
+    assert workers.stats()["max_ms"] > 0
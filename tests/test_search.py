@@ -1,9 +1,17 @@
 import os
+import queue
 import tempfile
+import threading
 import time
+from datetime import datetime, timedelta
+from hashlib import sha256
+from multiprocessing import Queue
 from unittest import mock
 
-from search import Search, Watchdog
+from plaintext import markdown_to_text, page_tags
+from search import CONTENT_STORAGE, EVENT_RATE_INTERVAL, WATCHDOG_CHANGED, WATCHDOG_STARTED, Search, Watchdog
+from watchdog.events import DirCreatedEvent, DirModifiedEvent, FileCreatedEvent, FileModifiedEvent, FileOpenedEvent
+from watchdog.observers import Observer
 from wiki import app
 
 
@@ -31,6 +39,156 @@ def test_index_and_search():
     assert "index" in sug
 
 
+def test_searcher_refreshed_on_new_generation():
+    tmp = tempfile.mkdtemp()
+    s = Search(tmp, create=True)
+    s.index(tmp, "a.md", "a", "first page")
+    assert s.search("first", 1)[1] == 1
+
+    # the same searcher is reused while the index doesn't change
+    with s.searcher() as first:
+        pass
+    with s.searcher() as second:
+        assert second is first
+    assert s.refreshes == 0
+
+    # a commit from another Search instance (like the Watchdog process) is seen by the next query
+    Search(tmp).index(tmp, "b.md", "b", "second page")
+    assert s.search("second", 1)[1] == 1
+    assert s.refreshes == 1
+    s.close()
+
+
+def test_search_from_threads():
+    tmp = tempfile.mkdtemp()
+    s = Search(tmp, create=True)
+    for n in range(20):
+        s.index(tmp, f"{n}.md", f"page {n}", f"shared content {n}")
+
+    totals, errors = [], []
+
+    def query():
+        try:
+            for _ in range(10):
+                totals.append(s.search("shared", 1)[1])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=query) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert totals == [20] * 80
+    assert len(s._searchers) <= Search.MAX_IDLE_SEARCHERS
+    s.close()
+
+
+def test_suggestions_only_for_few_results():
+    tmp = tempfile.mkdtemp()
+    s = Search(tmp, create=True)
+    for n in range(5):
+        s.index(tmp, f"{n}.md", f"page {n}", "index search")
+    s.index(tmp, "rare.md", "rare", "indexes indexed")
+
+    assert s.search("indx", 1)[3][0] == "index"  # no results, the most frequent word first
+    assert s.search("index", 1, suggest_below=3)[3] == []
+    assert s.search("indexes", 1, suggest_below=3)[3] != []
+    assert "index" in s.suggest("indexs")
+
+    # the corrector is kept until the index changes
+    with s.searcher() as searcher:
+        assert s.corrector(searcher) is s.corrector(searcher)
+    s.index(tmp, "new.md", "new", "indexing")
+    assert "indexing" in s.suggest("indexin")
+
+
+def test_search_results_cached_until_index_changes():
+    tmp = tempfile.mkdtemp()
+    s = Search(tmp, create=True, cache_size=2)
+    s.index(tmp, "a.md", "a", "runbook for the vpn")
+
+    first = s.search("runbook", 1)
+    assert s.search("  runbook ", 1) is first
+    assert s.results.stats()["hits"] == 1
+
+    # a new generation of the index drops the cached results
+    s.index(tmp, "b.md", "b", "oncall runbook")
+    assert s.search("runbook", 1)[1] == 2
+    assert s.results.stats()["entries"] == 1
+
+    s.search("vpn", 1)
+    s.search("oncall", 1)
+    assert s.results.stats()["entries"] == 2
+    assert s.search("runbook", 1)[1] == 2
+    assert s.results.stats()["hits"] == 1
+
+
+def test_search_results_on_relative_dates_not_cached():
+    tmp = tempfile.mkdtemp()
+    s = Search(tmp, create=True)
+    s.index(tmp, "a.md", "a", "runbook for the vpn", mtime=time.time())
+    assert s.search("runbook changed:today", 1)[1] == 1
+    assert s.results.stats()["entries"] == 0
+
+    # the next day, without any change of the index
+    tomorrow = datetime.now() + timedelta(days=1)
+    with mock.patch("search.datetime", wraps=datetime) as patched:
+        patched.now.return_value = tomorrow
+        assert s.search("runbook changed:today", 1)[1] == 0
+
+
+def test_content_storage():
+    tmpd = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmpd, "folder"))
+    files = []
+    for n in range(20):
+        with open(os.path.join(tmpd, "folder", f"p{n}.md"), "w") as f:
+            f.write(f"# page {n}\n\n" + "some text about the wiki search. " * 50 + f"The backup runbook {n}.")
+        files.append((f"p{n}.md", f"p{n}", "folder"))
+
+    highlights, sizes = {}, {}
+    for storage in CONTENT_STORAGE:
+        s = Search(tempfile.mkdtemp(), create=True, content_storage=storage, wiki_directory=tmpd)
+        s.index_all(tmpd, files)
+        res, total, _, _ = s.search("runbook", 1)
+        assert total == 20
+        highlights[storage] = sorted(r.highlights for r in res)
+        sizes[storage] = s.size()
+        with s.searcher() as searcher:
+            assert ("text" in searcher.stored_fields(0)) == (storage != "none")
+
+    assert "runbook" in highlights["none"][0]
+    assert highlights["full"] == highlights["none"]
+    assert sizes["none"] < sizes["full"]
+
+
+def test_structured_filters_and_date_sort():
+    tmp = tempfile.mkdtemp()
+    s = Search(tmp, create=True)
+    now = time.time()
+    s.index("ops/runbooks", "vpn.md", "vpn", "---\ntags: [oncall, VPN]\n---\n# VPN runbook", now - 60)
+    s.index("ops", "legacy.md", "legacy", "# Legacy runbook\nthe old vpn", now - 400 * 86400)
+    s.index(".", "notes.md", "notes", "Tags: meeting\n\nrunbook review", now)
+
+    def found(term, **kwargs):
+        return [r.filename for r in s.search(term, 1, **kwargs)[0]]
+
+    assert sorted(found("runbook folder:ops")) == ["legacy.md", "vpn.md"]
+    assert found("runbook in:ops/runbooks") == ["vpn.md"]
+    assert found("tag:vpn") == ["vpn.md"]
+    assert found("tag:meeting runbook") == ["notes.md"]
+    assert found("title:legacy") == ["legacy.md"]
+    assert "notes.md" in found("runbook modified:today")
+    assert "legacy.md" not in found("runbook modified:today")
+    assert found("runbook changed:[-1 month to now]", sort="mtime") == ["notes.md", "vpn.md"]
+    assert found("runbook", sort="mtime") == ["notes.md", "vpn.md", "legacy.md"]
+    # a date whoosh can't parse doesn't fail the search
+    assert found("runbook modified:[last month to now]") == []
+
+
 def test_pagination():
     tmp = tempfile.mkdtemp()
     s = Search(tmp, create=True)
@@ -94,11 +252,33 @@ def test_index_all():
     assert z.filename == "y.md"
 
 
+def test_index_all_in_processes():
+    tmps, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    s = Search(tmps, create=True)
+    nf = []
+    for n in range(20):
+        fname = f"p{n}.md"
+        with open(os.path.join(tmpd, fname), "w") as f:
+            f.write(f"# page {n}\n\nindex **search** test{n}")
+        nf.append((fname, f"p{n}", "."))
+
+    s.index_all(tmpd, nf, procs=3, limitmb=32)
+    res, total, pages, _ = s.search("index", 1)
+    assert total == 20
+    res, total, pages, _ = s.search("test7", 1)
+    assert total == 1
+    assert res[0].filename == "p7.md"
+    assert "search" in res[0].highlights
+
+
 def test_watchdog():
     tmps, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
     s = Search(tmps, create=True)
-    w = Watchdog(tmpd, tmps)
+    events = Queue()
+    w = Watchdog(tmpd, tmps, events)
     w.start()
+    # the changes made before the observer runs are not seen
+    assert events.get(timeout=10) == (WATCHDOG_STARTED, None)
 
     assert s.search("index", 1) == ([], 0, 0, [])
 
@@ -162,8 +342,11 @@ def test_watchdog():
 def test_watchdog_subdirectory():
     tmps, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
     s = Search(tmps, create=True)
-    w = Watchdog(tmpd, tmps)
+    events = Queue()
+    w = Watchdog(tmpd, tmps, events)
     w.start()
+    # the changes made before the observer runs are not seen
+    assert events.get(timeout=10) == (WATCHDOG_STARTED, None)
 
     assert s.search("index", 1) == ([], 0, 0, [])
     # test index subdir
@@ -202,3 +385,209 @@ def test_watchdog_subdirectory():
     assert len(res) == 0
 
     w.stop()
+
+
+def test_watchdog_batches_debounced_changes():
+    tmps, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    s = Search(tmps, create=True)
+    w = Watchdog(tmpd, tmps, flush_interval=1)
+    os.makedirs(os.path.join(tmpd, "sub"))
+    a, b = os.path.join(tmpd, "a.md"), os.path.join(tmpd, "sub", "b.md")
+
+    # several saves of the same page within the flush interval
+    for n in range(5):
+        with open(a, "w") as f:
+            f.write(f"draft revision{n}")
+        w.queue(a, now=100 + n * 0.1)
+    with open(b, "w") as f:
+        f.write("draft in a folder")
+    w.queue(b, now=100)
+
+    assert w.flush(now=101.2) == 1  # only b.md is quiet for long enough
+    assert w.flush(now=102) == 1
+    assert w.stats()["max_lag_ms"] == 2000
+    assert w.stats()["batches"] == 2
+    assert w.stats()["pending"] == 0
+
+    res, total, _, _ = s.search("draft", 1)
+    assert total == 2
+    assert {(r.path, r.filename) for r in res} == {(".", "a.md"), ("sub", "b.md")}
+    assert s.search("revision4", 1)[1] == 1
+
+    # removed pages and folders
+    os.remove(a)
+    os.remove(b)
+    os.rmdir(os.path.join(tmpd, "sub"))
+    w.queue(a, now=200)
+    w.queue(os.path.join(tmpd, "sub"), is_directory=True, now=200)
+    assert w.flush(now=201) == 2
+    assert s.search("draft", 1)[1] == 0
+    assert w.stats()["max_batch"] == 2
+
+
+def test_watchdog_skips_excluded_folders():
+    tmps, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    Search(tmps, create=True)
+    for folder in (".git/objects", "img", "protected/img", "protected/notes", "pages/sub"):
+        os.makedirs(os.path.join(tmpd, folder))
+    w = Watchdog(tmpd, tmps, excluded=[".git", "img", "protected/img"])
+    observer = Observer()
+    w.schedule(observer, tmpd)
+
+    watches = {os.path.relpath(path, tmpd): watch.is_recursive for path, watch in w._watches.items()}
+    assert watches == {".": False, "pages": True, "protected": False, "protected/notes": True}
+
+    # a new folder next to an excluded one gets a watch of its own
+    os.makedirs(os.path.join(tmpd, "new"))
+    w._observer = observer
+    w.dispatch(DirCreatedEvent(os.path.join(tmpd, "new")))
+    assert os.path.join(tmpd, "new") in w._watches
+
+    w.dispatch(FileModifiedEvent(os.path.join(tmpd, ".git", "index")))
+    w.dispatch(FileOpenedEvent(os.path.join(tmpd, "pages", "a.md")))
+    w.dispatch(FileModifiedEvent(os.path.join(tmpd, "pages", "a.md")))
+    assert sorted(w._pending) == [os.path.join(tmpd, "new"), os.path.join(tmpd, "pages", "a.md")]
+    assert w.stats()["events"] == 4
+    assert w.stats()["events_ignored"] == 2
+
+    w.report_event_rate(now=w._rate_start + EVENT_RATE_INTERVAL)
+    assert w.stats()["events_per_s"] == 4 / EVENT_RATE_INTERVAL
+
+
+def test_watchdog_never_excludes_the_wiki():
+    tmps, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    Search(tmps, create=True)
+    os.makedirs(os.path.join(tmpd, "img"))
+    w = Watchdog(tmpd, tmps, excluded=[".", "", "./", "/", "img/", "../other"])
+    assert w.excluded == ["img"]
+    w.schedule(Observer(), tmpd)
+    assert list(w._watches) == [tmpd]
+
+
+def test_index_updates_page():
+    tmp = tempfile.mkdtemp()
+    s = Search(tmp, create=True)
+    s.index("folder", "a.md", "a", "first version")
+    s.index("folder", "b.md", "b", "other page")
+    s.index("folder", "a.md", "a", "second version")
+    assert s.search("version", 1)[1] == 1
+    assert s.search("page", 1)[1] == 1
+
+
+def test_watchdog_reports_changes():
+    tmps, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    Search(tmps, create=True)
+    events = Queue()
+    w = Watchdog(tmpd, tmps, events)
+    w.start()
+    assert events.get(timeout=10) == (WATCHDOG_STARTED, None)
+
+    fpath = os.path.join(tmpd, "a.md")
+    with open(fpath, "w") as f:
+        f.write("# a")
+    changed = set()
+    while fpath not in changed:
+        kind, path = events.get(timeout=10)
+        assert kind == WATCHDOG_CHANGED
+        changed.add(path)
+
+    w.stop()
+
+
+def test_watchdog_reports_files_not_their_folder():
+    tmps, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+    Search(tmps, create=True)
+    events = queue.Queue()
+    w = Watchdog(tmpd, tmps, events)
+    folder, page = os.path.join(tmpd, "ops"), os.path.join(tmpd, "ops", "new.md")
+
+    # a new page also modifies its folder, only the page is reported
+    w.dispatch(FileCreatedEvent(page))
+    w.dispatch(DirModifiedEvent(folder))
+    w.dispatch(DirCreatedEvent(os.path.join(tmpd, "new")))
+    reported = []
+    while not events.empty():
+        reported.append(events.get())
+    assert reported == [(WATCHDOG_CHANGED, page), (WATCHDOG_CHANGED, os.path.join(tmpd, "new"))]
+
+
+def test_reconcile():
+    tmps, tmpd = tempfile.mkdtemp(), tempfile.mkdtemp()
+
+    def write(name: str, content: str):
+        with open(os.path.join(tmpd, name), "w") as f:
+            f.write(content)
+
+    def files():
+        items = []
+        for name in sorted(os.listdir(tmpd)):
+            with open(os.path.join(tmpd, name), "rb") as f:
+                items.append((name, name[:-3], ".", sha256(f.read()).hexdigest()))
+        return items
+
+    write("a.md", "apple")
+    write("b.md", "banana")
+    write("c.md", "cherry")
+    assert Search.open_or_create(tmps).reconcile(tmpd, files()) == (3, 0)
+
+    # reopened on the next start: only the changes are applied
+    write("b.md", "blueberry")
+    os.utime(os.path.join(tmpd, "c.md"), (1, 1))
+    os.remove(os.path.join(tmpd, "a.md"))
+    s = Search.open_or_create(tmps)
+    assert s.reconcile(tmpd, files()) == (1, 1)
+    assert s.search("apple", 1)[1] == 0
+    assert s.search("banana", 1)[1] == 0
+    assert s.search("blueberry", 1)[1] == 1
+    assert s.search("cherry", 1)[1] == 1
+    assert s.reconcile(tmpd, files()) == (0, 0)
+
+
+def test_textify_strips_markdown_syntax():
+    md = "\n".join((
+        "title: meta data",
+        "",
+        "# Heading #",
+        "Some **bold**, _emphasis_ and snake_case with a [link](/page \"title\") and ![an image](/img/a.png).",
+        "",
+        "| name | value |",
+        "|------|:-----:|",
+        "| a    | 1 &amp; 2 |",
+        "",
+        "```python",
+        "x = a_b * 2  # <kbd>",
+        "```",
+        "",
+        "- item `<span>` one",
+        "    - nested",
+        "> quoted text<!-- comment -->",
+        "",
+        "Footnote[^1]",
+        "",
+        "[^1]: the note",
+    ))
+    assert markdown_to_text(md) == "\n".join((
+        "Heading",
+        "Some bold, emphasis and snake_case with a link and .",
+        "",
+        "name value",
+        "a 1 & 2",
+        "",
+        "x = a_b * 2  # <kbd>",
+        "",
+        "item <span> one",
+        "nested",
+        "quoted text",
+        "",
+        "Footnote",
+        "",
+        "the note",
+    ))
+
+
+def test_page_tags():
+    assert page_tags("---\ntitle: page\ntags: [oncall, vpn]\n---\n# page") == ["oncall", "vpn"]
+    assert page_tags("---\ntags:\n  - backup\n  - 2024\n---\n") == ["backup", "2024"]
+    assert page_tags("Title: page\nTags: runbook, ops\n\n# page") == ["runbook", "ops"]
+    assert page_tags("# page\ntags: not meta-data") == []
+    assert page_tags("---\ntags: [unclosed\n---\n") == []
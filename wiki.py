@@ -1,24 +1,30 @@
+import calendar
+import json
 import os
 from shutil import ExecError
 import shutil
 import platform
 import time
 import logging
+import math
+import queue
 import uuid
-from lxml.html.clean import Cleaner
-import pypandoc
-import knowledge_graph
 import secrets
 import re
 
-from flask import Flask, render_template, request, redirect, url_for, make_response, safe_join, send_file, send_from_directory
-from threading import Thread
+from flask import Flask, render_template, request, redirect, url_for, make_response, safe_join, send_file, send_from_directory, jsonify
+from multiprocessing import Queue
+from threading import Lock, Thread
 from hashlib import sha256
-from cache import Cache
+from typing import Callable, List, Optional, Tuple
+from catalog import SORT_MODES, Folder, Page, PageCatalog
+from cache import INVALIDATION_MODES, RESPONSE_ENCODINGS, Cache, file_stamps, render_fingerprint
+from renderer import CacheWarmer, PANDOC_EXTRA_ARGS, PANDOC_FILTERS, get_pandoc_version, get_renderer
 from image_manager import ImageManager
+from knowledge_graph import KnowledgeGraph
 from config import WikmdConfig
 from git_manager import WikiRepoManager
-from search import Search, Watchdog
+from search import SEARCH_SORT_MODES, WATCHDOG_CHANGED, WATCHDOG_FAILED, WATCHDOG_STARTED, Search, Watchdog
 from web_dependencies import get_web_deps
 from plugins.load_plugins import PluginLoader
 
@@ -53,7 +59,25 @@ SYSTEM_SETTINGS = {
     "plugins": plugins
 }
 
-cache = Cache(cfg.cache_dir)
+cache = Cache(cfg.cache_dir, render_fingerprint(
+    get_pandoc_version(), PANDOC_EXTRA_ARGS, PANDOC_FILTERS, cfg.plugins
+), memory_size=cfg.cache_memory_size, max_entries=cfg.cache_max_entries, max_size=cfg.cache_max_size,
+    eviction_policy=cfg.cache_eviction_policy)
+
+renderer = get_renderer(cfg.render_backend, cfg.render_workers, app.logger)
+
+# the *.md pages of the wiki, shared by the list, search, knowledge graph and images cleanup
+catalog = PageCatalog(cfg.wiki_directory, ['.git', cfg.images_route, cfg.images_protected_route])
+
+# links between the pages for the knowledge graph, kept current with the catalog
+link_graph = KnowledgeGraph(catalog)
+
+# search index shared by the search requests, its searchers are refreshed when the index changes
+search_index: Optional[Search] = None
+search_index_lock = Lock()
+
+# time of the last change of the settings that affect every page (e.g. the theme), used for Last-Modified
+SETTINGS_MODIFIED = time.time()
 
 im = ImageManager(app, cfg)
 
@@ -78,24 +102,164 @@ def save(page_name):
             os.makedirs(dirname)
         with open(filename, 'w') as f:
             f.write(content)
+        cache.invalidate(filename)
+        catalog.update(filename)
+        link_graph.update(filename)
     except Exception as e:
         app.logger.error(f"Error while saving '{page_name}' >>> {str(e)}")
 
 
+def process_before_cache(html: str, page_name: str) -> str:
+    """
+    Function that runs the 'process_before_cache_html' plugins on the html of a page.
+    """
+    for plugin in plugins:
+        if ("process_before_cache_html" in dir(plugin)):
+            app.logger.info(f"Plug/{plugin.get_plugin_name()} - process_before_cache_html >>> {page_name}")
+            html = plugin.process_before_cache_html(html)
+
+    return html
+
+
+def html_dependencies(html: str) -> Optional[List[str]]:
+    """
+    Function that returns the files read by the 'process_html' plugins for this html.
+    Returns None if a plugin doesn't declare its dependencies: its output can't be cached then.
+    """
+    dependencies = []
+    for plugin in plugins:
+        if ("process_html" in dir(plugin)):
+            if ("get_html_dependencies" not in dir(plugin)):
+                return None
+            dependencies.extend(plugin.get_html_dependencies(html))
+    return dependencies
+
+
+def process_html(html: str, page_name: str) -> str:
+    """
+    Function that runs the 'process_html' plugins on the html of a page.
+    """
+    for plugin in plugins:
+        if ("process_html" in dir(plugin)):
+            app.logger.info(f"Plug/{plugin.get_plugin_name()} - process_html >>> {page_name}")
+            html = plugin.process_html(html)
+
+    return html
+
+
+def render_page(md_file_path: str, page_name: str) -> str:
+    """
+    Function that renders a *.md page into the html that gets cached:
+    pandoc conversion, html cleaning and the 'process_before_cache_html' plugins.
+    """
+    app.logger.info(f"Converting to HTML with pandoc >>> '{md_file_path}' ...")
+    return process_before_cache(renderer.render(md_file_path), page_name)
+
+
+def response_version() -> str:
+    """
+    Function that returns a hash of everything that shapes a page response besides the page itself:
+    templates, web dependencies and the render pipeline.
+    """
+    hasher = sha256(cache.fingerprint.encode("utf-8"))
+    hasher.update(repr(sorted(web_deps.items())).encode("utf-8"))
+    templates_dir = os.path.join(app.root_path, app.template_folder)
+    for name in sorted(os.listdir(templates_dir)):
+        with open(os.path.join(templates_dir, name), "rb") as f:
+            hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+RESPONSE_VERSION = response_version()
+
+
+def page_validators(template: str, cache_key: str, mtime: float,
+                    dependencies: Optional[dict] = None) -> Tuple[str, int]:
+    """
+    Function that returns the ETag and the Last-Modified time of a rendered page.
+    The ETag changes with the page source, the files its plugins depend on, the templates and the theme.
+    The requested path and the template are part of it, as the title and breadcrumbs come from the path:
+    two pages with the same content are two different representations.
+    :param template: name of the template the page is rendered with
+    """
+    dependencies = dependencies or {}
+    state = [RESPONSE_VERSION, SYSTEM_SETTINGS["darktheme"], request.path, template, cache_key, mtime, dependencies]
+    etag = sha256(json.dumps(state, sort_keys=True).encode("utf-8")).hexdigest()
+    last_modified = max([mtime, SETTINGS_MODIFIED] + [stamp[0] / 1e9 for stamp in dependencies.values() if stamp])
+    return etag, int(last_modified)
+
+
+def accepted_encoding() -> Optional[str]:
+    """
+    Function that returns the preferred precompressed encoding accepted by the client, if any.
+    """
+    for encoding in RESPONSE_ENCODINGS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def conditional_response(etag: str, last_modified: int, render: Callable[[], str]):
+    """
+    Function that answers with '304 Not Modified' if the client has the current version of a page,
+    otherwise renders it. If-None-Match takes precedence over If-Modified-Since.
+    The body is served precompressed when the client accepts it, the compressed bytes are cached per page version.
+    """
+    encoding = accepted_encoding()
+    # each content encoding is a different representation, with its own entity tag
+    response_etag = f"{etag}-{encoding}" if encoding else etag
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(response_etag)
+    elif request.if_modified_since:
+        not_modified = last_modified <= calendar.timegm(request.if_modified_since.utctimetuple())
+    else:
+        not_modified = False
+
+    if not_modified:
+        response = make_response("", 304)
+    elif encoding:
+        response = make_response(cache.get_response(etag, encoding, render))
+        response.content_encoding = encoding
+    else:
+        response = make_response(render())
+    response.set_etag(response_etag)
+    response.last_modified = last_modified
+    response.vary.add("Accept-Encoding")
+    # browsers may keep the page, but have to revalidate it on each visit
+    response.cache_control.no_cache = True
+    return response
+
+
+def get_search_index() -> Search:
+    """
+    Function that returns the shared search index, opened on first use.
+    """
+    global search_index
+    with search_index_lock:
+        if search_index is None:
+            search_index = Search(cfg.search_dir, cache_size=cfg.search_cache_size,
+                                  content_storage=cfg.search_content_storage, wiki_directory=cfg.wiki_directory)
+        return search_index
+
+
 def search(search_term: str, page: int):
     """
     Function that searches for a term and shows the results.
     """
     app.logger.info(f"Searching >>> '{search_term}' ...")
-    search = Search(cfg.search_dir)
     page = int(page)
-    results, num_results, num_pages, suggestions = search.search(search_term, page)
+    sort = request.args.get("sort")
+    if sort not in SEARCH_SORT_MODES:
+        sort = "score"
+    results, num_results, num_pages, suggestions = get_search_index().search(search_term, page,
+                                                                             cfg.search_suggest_below, sort)
     return render_template(
         'search.html',
         search_term=search_term,
         num_results=num_results,
         num_pages=num_pages,
         current_page=page,
+        sort=sort,
         suggestions=suggestions,
         results=results,
         system=SYSTEM_SETTINGS,
@@ -108,6 +272,50 @@ def fetch_page_name() -> str:
         page_name = f"{page_name[:-4]}{uuid.uuid4().hex}"
     return page_name
 
+def list_entries(folderpath: str, page: int, sort: str) -> dict:
+    """
+    Function that returns one page of the listing of a folder: its direct subfolders, then its pages.
+    The entries come from the presorted indexes of the page catalog.
+    :param sort: 'name' (a-z) or 'mtime' (last modified first)
+    """
+    folderpath = folderpath.strip("/")
+    entries = [
+        entry for entry in catalog.children(folderpath, sort)
+        if not (isinstance(entry, Folder) and entry.path in cfg.hide_folder_in_wiki)
+        and not (isinstance(entry, Page) and (entry.folder in cfg.hide_folder_in_wiki or entry.path == cfg.homepage))
+    ]
+    num_pages = max(1, math.ceil(len(entries) / cfg.list_page_size))
+    page = min(max(1, page), num_pages)
+    start = (page - 1) * cfg.list_page_size
+
+    items = []
+    for entry in entries[start:start + cfg.list_page_size]:
+        if isinstance(entry, Folder):
+            items.append({'type': 'folder',
+                          'name': entry.name,
+                          'url': f"/list/{entry.path}/",
+                          'folder': entry.path,
+                          'pages': entry.pages,
+                          'mtime': entry.mtime,
+                          })
+        else:
+            items.append({'type': 'page',
+                          'doc': os.path.basename(entry.path),
+                          'url': "/" + os.path.splitext(entry.path)[0],
+                          'folder': entry.folder,
+                          'mtime': entry.mtime,
+                          })
+    return {'folder': folderpath, 'sort': sort, 'page': page, 'num_pages': num_pages, 'total': len(entries),
+            'entries': items}
+
+
+def list_sort() -> str:
+    sort = request.args.get("sort")
+    if sort in SORT_MODES:
+        return sort
+    return "mtime" if SYSTEM_SETTINGS['listsortMTime'] else "name"
+
+
 @app.route('/list/', methods=['GET'])
 def list_full_wiki():
     return list_wiki("")
@@ -115,53 +323,70 @@ def list_full_wiki():
 
 @app.route('/list/<path:folderpath>/', methods=['GET'])
 def list_wiki(folderpath):
-    folder_list = []
     requested_path = safe_join(cfg.wiki_directory, folderpath)
     if requested_path is None:
         app.logger.info("Requesting unsafe path >> showing homepage")
         return index()
-    app.logger.info("Showing >>> 'all files'")
-    for root, subfolder, files in os.walk(requested_path):
-        if root[-1] == '/':
-            root = root[:-1]
-        for item in files:
-            path = os.path.join(root, item)
-            mtime = os.path.getmtime(os.path.join(root, item))
-            if (
-                root.startswith(os.path.join(cfg.wiki_directory, '.git')) or
-                root.startswith(os.path.join(cfg.wiki_directory, cfg.images_route)) or
-                root.startswith(os.path.join(cfg.wiki_directory, cfg.images_protected_route))
-            ):
-                continue
-
-            folder = root[len(cfg.wiki_directory + "/"):]
-            if folder in cfg.hide_folder_in_wiki:
-                continue
-
-            if folder == "":
-                if item == cfg.homepage:
-                    continue
-                url = os.path.splitext(
-                    root[len(cfg.wiki_directory + "/"):] + "/" + item)[0]
-            else:
-                url = "/" + \
-                    os.path.splitext(
-                        root[len(cfg.wiki_directory + "/"):] + "/" + item)[0]
-
-            info = {'doc': item,
-                    'url': url,
-                    'folder': folder,
-                    'folder_url': folder,
-                    'mtime': mtime,
-                    }
-            folder_list.append(info)
-
-    if SYSTEM_SETTINGS['listsortMTime']:
-        folder_list.sort(key=lambda x: x["mtime"], reverse=True)
-    else:
-        folder_list.sort(key=lambda x: (str(x["url"]).casefold()))
+    app.logger.info(f"Showing >>> 'all files' in '{folderpath}'")
+    try:
+        page = int(request.args.get("page", 1))
+    except ValueError:
+        page = 1
+    listing = list_entries(folderpath, page, list_sort())
+    return render_template('list_files.html', listing=listing, folder=folderpath, system=SYSTEM_SETTINGS)
+
 
-    return render_template('list_files.html', list=folder_list, folder=folderpath, system=SYSTEM_SETTINGS)
+@app.route('/api/list', methods=['GET'])
+def list_wiki_json():
+    """
+    JSON listing of a folder, used by the list page to expand folders and load more entries.
+    """
+    folderpath = request.args.get("folder", "")
+    if safe_join(cfg.wiki_directory, folderpath) is None:
+        return make_response(jsonify({'error': "unsafe path"}), 400)
+    try:
+        page = int(request.args.get("page", 1))
+    except ValueError:
+        return make_response(jsonify({'error': "invalid page"}), 400)
+    return jsonify(list_entries(folderpath, page, list_sort()))
+
+
+@app.route('/api/suggest', methods=['GET'])
+def suggest_json():
+    """
+    JSON spelling suggestions for a search term, for the searches that didn't compute them.
+    """
+    return jsonify({'suggestions': get_search_index().suggest(request.args.get("q", ""))})
+
+
+@app.route('/api/complete', methods=['GET'])
+def complete_json():
+    """
+    JSON completions of a page name (title or path) for a prefix, from the prefix index of the page catalog.
+    """
+    try:
+        limit = min(max(0, int(request.args.get("limit", 10))), 50)
+    except ValueError:
+        return make_response(jsonify({'error': "invalid limit"}), 400)
+    pages = catalog.complete(request.args.get("q", ""), limit, where=lambda page: not is_hidden(page.folder))
+    return jsonify({'completions': [{'title': page.title,
+                                     'url': "/" + os.path.splitext(page.path)[0],
+                                     'folder': page.folder,
+                                     } for page in pages]})
+
+
+@app.route('/api/stats', methods=['GET'])
+def stats_json():
+    """
+    JSON counters of the render cache (memory and disk tiers, coalesced renders), the renderer and the search results
+    cache, to check how they perform on a running wiki.
+    """
+    with search_index_lock:
+        search = search_index
+    return jsonify({'cache': cache.stats(),
+                    'renderer': renderer.stats(),
+                    'search': search.results.stats() if search is not None else None,
+                    })
 
 
 @app.route('/<path:file_page>', methods=['GET'])
@@ -172,53 +397,43 @@ def file_page(file_page):
         html = ""
         mod = ""
         folder = ""
-        cleaner = Cleaner(forms=False)
 
         if "favicon" in file_page:  # if the GET request is not for the favicon
             return
 
         try:
             md_file_path = safe_join(cfg.wiki_directory, f"{file_page}.md")
-            mod = "Last modified: %s" % time.ctime(os.path.getmtime(md_file_path))
+            stamp = cache.stamp(md_file_path)
+            if stamp is None:
+                raise FileNotFoundError(f"No such page: '{md_file_path}'")
+            cache_key, mtime = stamp
+            mod = "Last modified: %s" % time.ctime(mtime)
             folder = file_page.split("/")
             file_page = folder[-1:][0]
             folder = folder[:-1]
             folder = "/".join(folder)
 
-            cached_entry = cache.get(md_file_path)
-            if cached_entry:
+            cached_page, dependencies = cache.get_page(cache_key)
+            if cached_page:
                 app.logger.info(f"Showing HTML page from cache >>> '{file_page}'")
-
-                for plugin in plugins:
-                    if ("process_html" in dir(plugin)):
-                        app.logger.info(f"Plug/{plugin.get_plugin_name()} - process_html >>> {file_page}")
-                        cached_entry = plugin.process_html(cached_entry)
-
-                return render_template(
-                    'content.html', title=file_page, folder=folder, info=cached_entry, modif=mod,
+                return conditional_response(*page_validators('content.html', cache_key, mtime, dependencies), lambda: render_template(
+                    'content.html', title=file_page, folder=folder, info=cached_page, modif=mod,
                     system=SYSTEM_SETTINGS
-                )
+                ))
 
             try:
-                app.logger.info(f"Converting to HTML with pandoc >>> '{md_file_path}' ...")
-
-                html = pypandoc.convert_file(md_file_path, "html5",
-                                    format='md', extra_args=["--mathjax"], filters=['pandoc-xnos'])
-                
-                html = cleaner.clean_html(html)
-
-                for plugin in plugins:
-                    if ("process_before_cache_html" in dir(plugin)):
-                        app.logger.info(f"Plug/{plugin.get_plugin_name()} - process_before_cache_html >>> {file_page}")
-                        html = plugin.process_before_cache_html(html)
-
-                cache.set(md_file_path, html)
-
-                for plugin in plugins:
-                    if ("process_html" in dir(plugin)):
-                        app.logger.info(f"Plug/{plugin.get_plugin_name()} - process_html >>> {file_page}")
-                        html = plugin.process_html(html)
-
+                html = cache.get_or_render(cache_key, md_file_path, lambda: render_page(md_file_path, file_page))
+
+                dependencies = html_dependencies(html)
+                if dependencies is not None:
+                    dependencies = file_stamps(dependencies)
+                html = process_html(html, file_page)
+                if dependencies is not None and cache.is_current(cache_key, md_file_path):
+                    cache.set_page(cache_key, html, dependencies)
+                    app.logger.info(f"Showing HTML page >>> '{file_page}'")
+                    return conditional_response(*page_validators('content.html', cache_key, mtime, dependencies), lambda: render_template(
+                        'content.html', title=file_page, folder=folder, info=html, modif=mod, system=SYSTEM_SETTINGS
+                    ))
 
                 app.logger.info(f"Showing HTML page >>> '{file_page}'")
             except Exception as a:
@@ -237,25 +452,22 @@ def index():
         return search(request.args.get("q"), request.args.get("page", 1))
     else:
         html = ""
-        cleaner = Cleaner(forms=False)
         app.logger.info("Showing HTML page >>> 'homepage'")
 
         md_file_path = os.path.join(cfg.wiki_directory, cfg.homepage)
-        cached_entry = cache.get(md_file_path)
+        cache_key, mtime = cache.stamp(md_file_path) or (None, 0)
+        cached_entry = cache.get(cache_key)
         if cached_entry:
             app.logger.info("Showing HTML page from cache >>> 'homepage'")
-            return render_template(
+            return conditional_response(*page_validators('index.html', cache_key, mtime), lambda: render_template(
                 'index.html', homepage=cached_entry, system=SYSTEM_SETTINGS
-            )
+            ))
 
         try:
-            app.logger.info("Converting to HTML with pandoc >>> 'homepage' ...")
-            html = pypandoc.convert_file(
-                md_file_path, "html5", format='md', extra_args=["--mathjax"],
-                filters=['pandoc-xnos'])
-            html = cleaner.clean_html(html)
-            cache.set(md_file_path, html)
-
+            html = cache.get_or_render(cache_key, md_file_path, lambda: render_page(md_file_path, "homepage"))
+            return conditional_response(*page_validators('index.html', cache_key, mtime), lambda: render_template(
+                'index.html', homepage=html, system=SYSTEM_SETTINGS
+            ))
         except Exception as e:
             app.logger.error(f"Conversion to HTML failed >>> {str(e)}")
 
@@ -315,6 +527,9 @@ def remove(page):
 
     filename = safe_join(cfg.wiki_directory, f"{page}.md")
     os.remove(filename)
+    cache.invalidate(filename)
+    catalog.update(filename)
+    link_graph.update(filename)
     git_sync_thread = Thread(target=wrm.git_sync, args=(page, "Remove"))
     git_sync_thread.start()
     return redirect("/")
@@ -330,6 +545,9 @@ def edit(page):
         page_name = fetch_page_name()
         if page_name != page:
             os.remove(filename)
+            cache.invalidate(filename)
+            catalog.update(filename)
+            link_graph.update(filename)
 
         save(page_name)
         git_sync_thread = Thread(target=wrm.git_sync, args=(page_name, "Edit"))
@@ -390,15 +608,16 @@ def communicate_plugins():
     if request.method == "POST":
         for plugin in plugins:
             if ("communicate_plugin" in dir(plugin)):
-                return plugin.communicate_plugin(request)
+                response = plugin.communicate_plugin(request)
+                # plugins may change the files that pages depend on (e.g. drawings)
+                cache.invalidate_dependencies()
+                return response
     return "nothing to do"
 
 
 @app.route('/knowledge-graph', methods=['GET'])
 def graph():
-    global links
-    links = knowledge_graph.find_links()
-    return render_template("knowledge-graph.html", links=links, system=SYSTEM_SETTINGS)
+    return render_template("knowledge-graph.html", links=link_graph.links(), system=SYSTEM_SETTINGS)
 
 
 @app.route('/login', methods=['GET','POST'])
@@ -424,9 +643,9 @@ def login(page):
 
 @app.route('/nav/<path:id>/', methods=['GET'])
 def nav_id_to_page(id):
-    for i in links:
-        if i["id"] == int(id):
-            return redirect("/"+i["path"])
+    path = link_graph.page(int(id))
+    if path is not None:
+        return redirect("/" + path)
     return redirect("/")
 
 
@@ -451,7 +670,9 @@ def display_protected_image(image_name):
 
 @app.route('/toggle-darktheme/', methods=['GET'])
 def toggle_darktheme():
+    global SETTINGS_MODIFIED
     SYSTEM_SETTINGS['darktheme'] = not SYSTEM_SETTINGS['darktheme']
+    SETTINGS_MODIFIED = time.time()
     return redirect(request.args.get("return", "/"))  # redirect to the same page URL
 
 
@@ -465,26 +686,91 @@ def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'),
                                'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
+def is_hidden(folder: str) -> bool:
+    """
+    Function that checks whether a folder of the wiki (relative) is in, or under, one of the hidden folders.
+    """
+    hidden_folders = [hidden.strip("/") for hidden in cfg.hide_folder_in_wiki]
+    return any(folder == hidden or folder.startswith(hidden + "/") for hidden in hidden_folders)
+
+
 def setup_search():
-    search = Search(cfg.search_dir, create=True)
+    """
+    Function that brings the persistent search index up to date with the pages of the wiki.
+    The index stays open for the search requests.
+    """
+    global search_index
+    search = Search.open_or_create(cfg.search_dir, cache_size=cfg.search_cache_size,
+                                   content_storage=cfg.search_content_storage, wiki_directory=cfg.wiki_directory)
 
-    app.logger.info("Search index creation...")
+    app.logger.info("Search index update...")
+    start = time.time()
     items = []
-    for root, subfolder, files in os.walk(cfg.wiki_directory):
-        for item in files:
-            if (
-                root.startswith(os.path.join(cfg.wiki_directory, '.git')) or
-                root.startswith(os.path.join(cfg.wiki_directory, cfg.images_route)) or
-                root.startswith(os.path.join(cfg.wiki_directory, cfg.images_protected_route))
-            ):
-                continue
-            page_name, ext = os.path.splitext(item)
-            if ext.lower() != ".md":
-                continue
-            path = os.path.relpath(root,cfg.wiki_directory)
-            items.append((item, page_name, path))
-
-    search.index_all(cfg.wiki_directory, items)
+    for page in catalog.pages():
+        # like the watchdog, the search index ignores the hidden folders
+        if not is_hidden(page.folder):
+            items.append((os.path.basename(page.path), page.title, page.folder or ".", page.hash))
+
+    indexed, deleted = search.reconcile(cfg.wiki_directory, items, cfg.search_index_procs, cfg.search_index_memory)
+    with search_index_lock:
+        previous, search_index = search_index, search
+    if previous is not None:
+        previous.close()
+    app.logger.info(f"Search index updated in {time.time() - start:.1f}s >>> "
+                    f"{indexed} indexed, {deleted} deleted, {len(items) - indexed} unchanged, "
+                    f"{search.size() / 1024 / 1024:.1f} MB ({cfg.search_content_storage} content)")
+
+
+def setup_cache_warmup():
+    """
+    Function that pre-renders all the pages into the cache in the background.
+    The homepage goes first, then the most recently modified pages.
+    """
+    pages = []
+    for page in catalog.pages():
+        priority = 0 if page.path == cfg.homepage else 1
+        pages.append((priority, -page.mtime, catalog.file_path(page), page.title))
+    pages.sort()
+
+    warmer = CacheWarmer(cache, process_before_cache, app.logger,
+                         workers=cfg.cache_warmup_workers, delay=cfg.cache_warmup_delay, convert=renderer.convert)
+    warmer.start([(path, page_name) for _, _, path, page_name in pages])
+    return warmer
+
+
+def invalidate_cache_on_events(watchdog: Watchdog, events: Queue):
+    """
+    Function that invalidates the cache and updates the page catalog from the file system events of the watchdog.
+    Once the watchdog watches the wiki they stop checking the files on each request,
+    they go back to checking them if the watchdog fails or dies.
+    """
+    while True:
+        try:
+            kind, path = events.get(timeout=5)
+        except queue.Empty:
+            if not cache.verify and not watchdog.proc.is_alive():
+                cache.verify = catalog.verify = True
+                app.logger.warning("Cache invalidation >>> the watchdog died, checking the files on each request")
+            continue
+        try:
+            if kind == WATCHDOG_CHANGED:
+                cache.invalidate(path)
+                catalog.update(path)
+                link_graph.update(path)
+            elif kind == WATCHDOG_STARTED:
+                # the files read before the watchdog started may have changed in the meantime
+                cache.invalidate(cfg.wiki_directory)
+                catalog.scan()
+                link_graph.scan()
+                cache.verify = catalog.verify = False
+                app.logger.info("Cache invalidation >>> driven by file system events")
+            elif kind == WATCHDOG_FAILED:
+                cache.verify = catalog.verify = True
+                app.logger.warning("Cache invalidation >>> no file system events, checking the files on each request")
+        except Exception as e:
+            # a change may have been missed, the events can't be trusted anymore
+            cache.verify = catalog.verify = True
+            app.logger.error(f"Cache invalidation >>> failed on '{path}', checking the files on each request >>> {str(e)}")
 
 
 def run_wiki():
@@ -498,11 +784,26 @@ def run_wiki():
         app.logger.info(f"Creating upload folder >>> {UPLOAD_FOLDER}")
         os.mkdir(UPLOAD_FOLDER)
 
-    im.cleanup_images()
+    if cfg.cache_invalidation not in INVALIDATION_MODES:
+        raise ValueError(f"Unknown cache invalidation '{cfg.cache_invalidation}', expected one of {INVALIDATION_MODES}")
+    # scanned once for the setup below, and once more when the watchdog starts
+    catalog.verify = cfg.cache_invalidation == "verify"
+    catalog.scan()
+    link_graph.scan()
+    im.cleanup_images(catalog)
     setup_search()
+    if cfg.cache_warmup:
+        setup_cache_warmup()
     app.logger.info("Spawning search indexer watchdog")
-    watchdog = Watchdog(cfg.wiki_directory, cfg.search_dir)
+    events = Queue() if cfg.cache_invalidation == "events" else None
+    # no file system events for these folders, the pages of the hidden folders are checked on each request
+    excluded = ['.git', cfg.images_route, cfg.images_protected_route] + list(cfg.hide_folder_in_wiki)
+    cache.unwatched = [os.path.join(cfg.wiki_directory, folder) for folder in cfg.hide_folder_in_wiki]
+    watchdog = Watchdog(cfg.wiki_directory, cfg.search_dir, events, cfg.search_flush_interval, app.logger, excluded,
+                        cfg.search_content_storage)
     watchdog.start()
+    if events is not None:
+        Thread(target=invalidate_cache_on_events, args=(watchdog, events), daemon=True).start()
     app.run(host=cfg.wikmd_host, port=cfg.wikmd_port, debug=True, use_reloader=False)
 
 